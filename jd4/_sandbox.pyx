@@ -1,5 +1,6 @@
 # cython: c_string_type=str, c_string_encoding=ascii
 
+from libc.errno cimport errno
 from os import chdir, getegid, geteuid, makedirs, mkdir, mknod, path, \
                readlink, rmdir, setresgid, setresuid, symlink
 from socket import sethostname
@@ -27,6 +28,14 @@ cdef bind_or_link(src, target):
     elif path.isdir(src):
         bind_mount(src, target, True, False, True, True)
 
+def mount_tmpfs(const char* target, const char* data):
+    if mount(target, target, 'tmpfs', MS_NOSUID, data):
+        raise OSError(errno, 'mount failed', target)
+
+def umount_detach(const char* target):
+    if umount2(target, MNT_DETACH):
+        raise OSError(errno, 'umount failed', target)
+
 def create_namespace():
     host_euid = geteuid()
     host_egid = getegid()
@@ -0,0 +1,69 @@
+import json
+from asyncio import get_event_loop, open_unix_connection, start_unix_server
+from os import umask, unlink
+from sys import argv
+
+from jd4.config import config
+from jd4.log import logger
+
+_commands = dict()
+
+def admin_add_command(name, callback):
+    """Registers an async callback that takes the request fields as keyword arguments."""
+    _commands[name] = callback
+
+async def _handle(reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                callback = _commands[request.pop('command')]
+                response = {'result': await callback(**request)}
+            except Exception as e:
+                logger.warning('Admin command failed: %r', e)
+                response = {'error': repr(e)}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+async def start_admin_server():
+    socket_path = config.get('admin_socket')
+    if not socket_path:
+        return None
+    try:
+        unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    # Create the socket owner-only, a chmod after bind would leave a window.
+    old_umask = umask(0o177)
+    try:
+        server = await start_unix_server(_handle, socket_path)
+    finally:
+        umask(old_umask)
+    logger.info('Admin socket: %s', socket_path)
+    return server
+
+async def _request(request):
+    reader, writer = await open_unix_connection(config['admin_socket'])
+    try:
+        writer.write(json.dumps(request).encode() + b'\n')
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+def main():
+    request = {'command': argv[1]}
+    for arg in argv[2:]:
+        key, _, value = arg.partition('=')
+        try:
+            request[key] = json.loads(value)
+        except ValueError:
+            request[key] = value
+    print(json.dumps(get_event_loop().run_until_complete(_request(request)), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+from asyncio import get_event_loop
+from os import path, stat, umask
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4 import admin
+from jd4.config import config
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class AdminTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.old_socket = config.get('admin_socket')
+        config['admin_socket'] = path.join(self.tmp_dir.name, 'admin.sock')
+        self.server = run(admin.start_admin_server())
+
+    def tearDown(self):
+        self.server.close()
+        run(self.server.wait_closed())
+        if self.old_socket is None:
+            del config['admin_socket']
+        else:
+            config['admin_socket'] = self.old_socket
+        self.tmp_dir.cleanup()
+
+    def test_command(self):
+        async def add(a, b):
+            return a + b
+        admin.admin_add_command('add', add)
+        self.assertEqual(run(admin._request({'command': 'add', 'a': 1, 'b': 2})),
+                         {'result': 3})
+
+    def test_permissions(self):
+        self.assertEqual(stat(config['admin_socket']).st_mode & 0o777, 0o600)
+        old_umask = umask(0o22)
+        umask(old_umask)
+        self.assertNotEqual(old_umask, 0o177)
+
+    def test_unknown_command(self):
+        self.assertIn('error', run(admin._request({'command': 'unknown'})))
+
+if __name__ == '__main__':
+    main()
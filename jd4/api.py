@@ -1,13 +1,22 @@
 import json
-from aiohttp import ClientSession, CookieJar
-from asyncio import CancelledError, Queue, get_event_loop
+from aiohttp import ClientConnectionError, ClientError, ClientPayloadError, \
+                    ClientSession, CookieJar
+from asyncio import CancelledError, Queue, Semaphore, gather, get_event_loop, shield, wait
 from appdirs import user_config_dir
-from os import path
+from os import ftruncate, path, posix_fallocate, pwrite, unlink
+from time import monotonic_ns
 from urllib.parse import urljoin
 
+from jd4.config import config
 from jd4.log import logger
+from jd4.util import parse_memory_bytes, read_text_file, write_binary_file, \
+                     write_text_file
 
 _CHUNK_SIZE = 32768
+_WRITE_SIZE = 1048576
+_DOWNLOAD_ATTEMPTS = 3
+DEFAULT_DOWNLOAD_PARTS = 4
+DEFAULT_DOWNLOAD_PART_SIZE = '16m'
 _CONFIG_DIR = user_config_dir('jd4')
 _COOKIES_FILE = path.join(_CONFIG_DIR, 'cookies')
 _COOKIE_JAR = CookieJar(unsafe=True)
@@ -15,6 +24,7 @@ try:
     _COOKIE_JAR.load(_COOKIES_FILE)
 except FileNotFoundError:
     pass
+_download_stats = {'bytes': 0, 'total_ns': 0}
 
 class VJ4Error(Exception):
     def __init__(self, name, message, *args):
@@ -32,10 +42,86 @@ async def json_response_to_dict(response):
                        *error.get('args', []))
     return response_dict
 
+def _preallocate(fd, size):
+    try:
+        posix_fallocate(fd, 0, size)
+    except OSError:
+        ftruncate(fd, size)
+
+def _open_save_file(save_path, offset, size):
+    save_file = open(save_path, 'r+b' if offset else 'wb')
+    try:
+        save_file.truncate(offset)
+        if size is not None:
+            _preallocate(save_file.fileno(), size)
+    except BaseException:
+        save_file.close()
+        raise
+    return save_file
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = pwrite(fd, view, offset)
+        if not written:
+            raise OSError('short write')
+        view = view[written:]
+        offset += written
+
+async def _write(fd, data, offset):
+    future = get_event_loop().run_in_executor(None, _pwrite_all, fd, data, offset)
+    try:
+        await shield(future)
+    except CancelledError:
+        # The write cannot be interrupted, keep the fd open until it ends.
+        await wait([future])
+        raise
+
+async def _save(response, fd, offset):
+    """Writes the response body at offset in large batches, returns the end offset."""
+    buffers = list()
+    size = 0
+    async for buffer in response.content.iter_chunked(_CHUNK_SIZE):
+        buffers.append(buffer)
+        size += len(buffer)
+        if size >= _WRITE_SIZE:
+            await _write(fd, b''.join(buffers), offset)
+            offset += size
+            buffers.clear()
+            size = 0
+    if buffers:
+        await _write(fd, b''.join(buffers), offset)
+        offset += size
+    return offset
+
+def download_stats():
+    return dict(_download_stats)
+
+def _remove_file(file_path):
+    try:
+        unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+def _response_validators(response):
+    validators = dict()
+    if 'ETag' in response.headers:
+        validators['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        validators['last_modified'] = response.headers['Last-Modified']
+    return validators
+
+def _if_range(validators):
+    etag = validators.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validators.get('last_modified')
+
 class VJ4Session(ClientSession):
     def __init__(self, server_url):
         super().__init__(cookie_jar=_COOKIE_JAR)
         self.server_url = server_url
+        self.judge_queue = None
 
     def full_url(self, *parts):
         return urljoin(self.server_url, path.join(*parts))
@@ -54,32 +140,53 @@ class VJ4Session(ClientSession):
                              data=kwargs) as response:
             return await json_response_to_dict(response)
 
-    async def judge_consume(self, handler_type):
+    async def judge_consume(self, handler_type, concurrency=1, drain=None):
+        """Handles judge requests until the connection is lost or drain is set.
+
+        When draining, requests not yet started are dropped and left to the
+        server, which delivers them again once the connection is closed."""
         async with self.ws_connect(self.full_url('judge/consume-conn/websocket')) as ws:
-            logger.info('Connected')
+            logger.info('Connected with concurrency %d', concurrency)
             queue = Queue()
+            self.judge_queue = queue
             async def worker():
-                try:
-                    while True:
-                        request = await queue.get()
+                while True:
+                    request = await queue.get()
+                    if request is None:
+                        break
+                    try:
                         await handler_type(self, request, ws).handle()
-                except CancelledError:
-                    raise
-                except Exception as e:
-                    logger.exception(e)
-                    await ws.close()
-            worker_task = get_event_loop().create_task(worker())
+                    except CancelledError:
+                        raise
+                    except ClientError as e:
+                        logger.exception(e)
+                        await ws.close()
+                    except Exception as e:
+                        logger.exception(e)
+            async def drainer():
+                await drain.wait()
+                logger.info('Draining %d queued requests', queue.qsize())
+                while not queue.empty():
+                    queue.get_nowait()
+                for _ in worker_tasks:
+                    queue.put_nowait(None)
+                await gather(*worker_tasks, return_exceptions=True)
+                await ws.close()
+            loop = get_event_loop()
+            worker_tasks = [loop.create_task(worker()) for _ in range(concurrency)]
+            tasks = list(worker_tasks)
+            if drain:
+                tasks.append(loop.create_task(drainer()))
             try:
                 while True:
                     queue.put_nowait(await ws.receive_json())
             except TypeError:
                 pass
             logger.warning('Connection lost with code %s', ws.close_code)
-            worker_task.cancel()
-            try:
-                await worker_task
-            except CancelledError:
-                pass
+            self.judge_queue = None
+            for task in tasks:
+                task.cancel()
+            await gather(*tasks, return_exceptions=True)
 
     async def judge_noop(self):
         await self.get_json('judge/noop')
@@ -103,11 +210,49 @@ class VJ4Session(ClientSession):
     async def judge_datalist(self, last):
         return await self.get_json('judge/datalist', last=last)
 
-    async def problem_data(self, domain_id, pid, save_path):
+    async def problem_data(self, domain_id, pid, save_path, validators=None):
+        """Downloads problem data to save_path and returns its validators.
+
+        A partial save_path left by an interrupted download is resumed with a
+        range request. If validators of a cached copy are given and the data
+        is not modified, returns None without downloading."""
         logger.info('Getting problem data: %s, %s', domain_id, pid)
-        loop = get_event_loop()
-        async with self.get(self.full_url('d', domain_id, 'p', pid, 'data'),
-                            headers={'accept': 'application/json'}) as response:
+        for attempt in range(_DOWNLOAD_ATTEMPTS):
+            try:
+                return await self._problem_data(domain_id, pid, save_path, validators)
+            except (ClientConnectionError, ClientPayloadError) as e:
+                if attempt + 1 == _DOWNLOAD_ATTEMPTS:
+                    raise
+                logger.warning('Resuming problem data %s, %s after %r', domain_id, pid, e)
+
+    async def _problem_data(self, domain_id, pid, save_path, validators):
+        url = self.full_url('d', domain_id, 'p', pid, 'data')
+        part_size = parse_memory_bytes(str(config.get('download_part_size',
+                                                      DEFAULT_DOWNLOAD_PART_SIZE)))
+        partial_path = save_path + '.json'
+        headers = {'accept': 'application/json'}
+        offset = 0
+        try:
+            partial_validators = json.loads(read_text_file(partial_path))
+            if_range = _if_range(partial_validators)
+            offset = path.getsize(save_path)
+        except (FileNotFoundError, ValueError):
+            partial_validators = None
+            if_range = None
+        if if_range and offset:
+            headers['range'] = 'bytes={}-'.format(offset)
+            headers['if-range'] = if_range
+        else:
+            # Ask for the first part to learn whether the server supports
+            # ranges and how large the data is.
+            offset = 0
+            headers['range'] = 'bytes=0-{}'.format(part_size - 1)
+        if validators and 'etag' in validators:
+            headers['if-none-match'] = validators['etag']
+        if validators and 'last_modified' in validators:
+            headers['if-modified-since'] = validators['last_modified']
+        start_ns = monotonic_ns()
+        async with self.get(url, headers=headers) as response:
             if response.content_type == 'application/json':
                 response_dict = await response.json()
                 if 'error' in response_dict:
@@ -116,14 +261,96 @@ class VJ4Session(ClientSession):
                                    error.get('message', ''),
                                    *error.get('args', []))
                 raise Exception('unexpected response')
-            if response.status != 200:
+            if response.status == 304 and validators:
+                return None
+            content_range = response.headers.get('Content-Range', '')
+            if response.status == 416 and offset:
+                _remove_file(partial_path)
+                if content_range == 'bytes */{}'.format(offset):
+                    # Only the partial file was left of a finished download.
+                    return partial_validators
+                logger.warning('Restarting problem data %s, %s', domain_id, pid)
+                response.release()
+                _remove_file(save_path)
+                return await self._problem_data(domain_id, pid, save_path, validators)
+            if response.status == 416 and content_range == 'bytes */0':
+                # Empty data has no first part to ask for.
+                write_binary_file(save_path, b'')
+                return _response_validators(response)
+            parted = False
+            total_size = None
+            if response.status == 206 and content_range.startswith('bytes {}-'.format(offset)):
+                if offset:
+                    logger.info('Resuming problem data at %d bytes', offset)
+                else:
+                    parted = True
+                    if content_range.rpartition('/')[2].isdigit():
+                        total_size = int(content_range.rpartition('/')[2])
+            elif response.status == 200:
+                offset = 0
+            else:
                 raise Exception('http error ' + str(response.status))
-            with open(save_path, 'wb') as save_file:
-                while True:
-                    buffer = await response.content.read(_CHUNK_SIZE)
-                    if not buffer:
-                        break
-                    await loop.run_in_executor(None, save_file.write, buffer)
+            new_validators = _response_validators(response)
+            if not offset:
+                _remove_file(partial_path)
+                # Parts downloaded in parallel leave holes, so only a single
+                # stream can be resumed.
+                if not parted and _if_range(new_validators):
+                    write_text_file(partial_path, json.dumps(new_validators))
+            # Without native fallocate, glibc writes every block of the file.
+            save_file = await get_event_loop().run_in_executor(
+                None, _open_save_file, save_path, offset, total_size)
+            with save_file:
+                end = await _save(response, save_file.fileno(), offset)
+                if parted and end != total_size:
+                    end = await self._problem_data_parts(
+                        url, save_file.fileno(), end, total_size, _if_range(new_validators))
+        _remove_file(partial_path)
+        elapsed_ns = monotonic_ns() - start_ns
+        _download_stats['bytes'] += end - offset
+        _download_stats['total_ns'] += elapsed_ns
+        logger.info('Downloaded %d bytes in %.3fs (%.1f MB/s)', end - offset, elapsed_ns / 1e9,
+                    (end - offset) / 1048576 / max(elapsed_ns / 1e9, 1e-9))
+        return new_validators
+
+    async def _problem_data_parts(self, url, fd, start, end, if_range):
+        """Downloads the rest of the data in parts, returns the end offset.
+
+        The rest is fetched in one open ended part if the size is unknown, or
+        without a validator, since parts could come from different versions."""
+        parts = config.get('download_parts', DEFAULT_DOWNLOAD_PARTS)
+        if end is None or not if_range:
+            parts = 1
+        part_size = -(-(end - start) // parts) if end is not None else None
+        semaphore = Semaphore(parts)
+
+        async def download(offset):
+            if part_size is None:
+                headers = {'range': 'bytes={}-'.format(offset)}
+            else:
+                headers = {'range': 'bytes={}-{}'.format(offset,
+                                                          min(offset + part_size, end) - 1)}
+            if if_range:
+                headers['if-range'] = if_range
+            async with semaphore, self.get(url, headers=headers) as response:
+                if response.status != 206 or not response.headers.get(
+                        'Content-Range', '').startswith('bytes {}-'.format(offset)):
+                    raise Exception('problem data changed during download')
+                return await _save(response, fd, offset)
+
+        if part_size is None:
+            return await download(start)
+        loop = get_event_loop()
+        tasks = [loop.create_task(download(offset)) for offset in range(start, end, part_size)]
+        try:
+            await gather(*tasks)
+        except BaseException:
+            # Parts still writing must stop before the caller closes the fd.
+            for task in tasks:
+                task.cancel()
+            await gather(*tasks, return_exceptions=True)
+            raise
+        return end
 
     async def record_pretest_data(self, rid):
         logger.info('Getting pretest data: %s', rid)
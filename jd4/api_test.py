@@ -0,0 +1,305 @@
+from aiohttp import web, ClientPayloadError
+from aiohttp.test_utils import TestServer
+from asyncio import Event, get_event_loop, sleep, wait_for
+from os import path, pwrite
+from tempfile import TemporaryDirectory
+from threading import current_thread, main_thread
+from unittest import main, TestCase
+
+from jd4 import api, daemon
+from jd4.api import VJ4Session
+from jd4.config import config
+from jd4.daemon import JudgeHandler
+from jd4.status import STATUS_ACCEPTED, STATUS_SYSTEM_ERROR
+from jd4.util import write_binary_file, write_text_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class DataServer:
+    def __init__(self):
+        self.data = bytes(range(256)) * 4096
+        self.etag = '"1"'
+        self.drop_after = None
+        self.drop_at = None
+        self.ranges = False
+        self.change_at = None
+        self.requests = list()
+
+    async def handle(self, request):
+        self.requests.append(request.headers.copy())
+        if len(self.requests) == self.change_at:
+            self.etag = '"2"'
+        if request.headers.get('If-None-Match') == self.etag:
+            return web.Response(status=304)
+        headers = {'ETag': self.etag, 'Content-Type': 'application/zip'}
+        start, end = 0, len(self.data)
+        if 'Range' in request.headers and \
+           request.headers.get('If-Range', self.etag if self.ranges else None) == self.etag:
+            first, _, last = request.headers['Range'][len('bytes='):].partition('-')
+            start, end = int(first), min(int(last or end - 1) + 1, end)
+            if start >= len(self.data):
+                return web.Response(status=416, headers={
+                    'ETag': self.etag, 'Content-Range': 'bytes */{}'.format(len(self.data))})
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, len(self.data))
+        body = self.data[start:end]
+        headers['Content-Length'] = str(len(body))
+        response = web.StreamResponse(status=206 if 'Content-Range' in headers else 200,
+                                      headers=headers)
+        await response.prepare(request)
+        if self.drop_after is not None and self.drop_at in (None, len(self.requests)):
+            await response.write(body[:self.drop_after])
+            self.drop_after = None
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+class ProblemDataTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.save_path = path.join(self.tmp_dir.name, 'tmp_1.zip')
+        self.server = DataServer()
+        app = web.Application()
+        app.router.add_get('/d/{domain_id}/p/{pid}/data', self.server.handle)
+        self.test_server = TestServer(app)
+        run(self.test_server.start_server())
+
+    def tearDown(self):
+        run(self.test_server.close())
+        self.tmp_dir.cleanup()
+        config.pop('download_part_size', None)
+
+    def problem_data(self, validators=None):
+        async def get():
+            async with VJ4Session(str(self.test_server.make_url('/'))) as session:
+                return await session.problem_data('system', '1', self.save_path, validators)
+        return run(get())
+
+    def read(self):
+        with open(self.save_path, 'rb') as file:
+            return file.read()
+
+    def test_download(self):
+        self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        self.assertEqual(self.read(), self.server.data)
+        self.assertFalse(path.exists(self.save_path + '.json'))
+
+    def test_resume(self):
+        write_binary_file(self.save_path, self.server.data[:1000])
+        write_text_file(self.save_path + '.json', '{"etag": "\\"1\\""}')
+        self.problem_data()
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual(self.server.requests[0]['Range'], 'bytes=1000-')
+
+    def test_resume_changed(self):
+        write_binary_file(self.save_path, b'x' * 1000)
+        write_text_file(self.save_path + '.json', '{"etag": "\\"0\\""}')
+        self.problem_data()
+        self.assertEqual(self.read(), self.server.data)
+
+    def test_resume_complete(self):
+        write_binary_file(self.save_path, self.server.data)
+        write_text_file(self.save_path + '.json', '{"etag": "\\"1\\""}')
+        self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        self.assertEqual(self.read(), self.server.data)
+        self.assertFalse(path.exists(self.save_path + '.json'))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_resume_too_long(self):
+        write_binary_file(self.save_path, self.server.data + b'x')
+        write_text_file(self.save_path + '.json', '{"etag": "\\"1\\""}')
+        self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn('If-Range', self.server.requests[1])
+
+    def test_empty(self):
+        self.server.data = b''
+        self.server.ranges = True
+        self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        self.assertEqual(self.read(), b'')
+
+    def test_dropped(self):
+        self.server.drop_after = 100000
+        self.problem_data()
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn('Range', self.server.requests[1])
+
+    def test_not_modified(self):
+        self.assertIsNone(self.problem_data({'etag': '"1"'}))
+        self.assertFalse(path.exists(self.save_path))
+        self.server.etag = '"2"'
+        self.assertEqual(self.problem_data({'etag': '"1"'}), {'etag': '"2"'})
+        self.assertEqual(self.read(), self.server.data)
+
+    def test_parts(self):
+        self.server.ranges = True
+        config['download_part_size'] = '100k'
+        self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual([headers['Range'] for headers in self.server.requests],
+                         ['bytes=0-102399', 'bytes=102400-338943', 'bytes=338944-575487',
+                          'bytes=575488-812031', 'bytes=812032-1048575'])
+        self.assertTrue(all(headers['If-Range'] == '"1"'
+                            for headers in self.server.requests[1:]))
+
+    def test_preallocate_off_loop(self):
+        self.server.ranges = True
+        config['download_part_size'] = '100k'
+        threads = list()
+
+        def preallocate(fd, size):
+            threads.append(current_thread())
+            old_preallocate(fd, size)
+        old_preallocate, api._preallocate = api._preallocate, preallocate
+        try:
+            self.problem_data()
+        finally:
+            api._preallocate = old_preallocate
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], main_thread())
+
+    def test_part_dropped(self):
+        self.server.ranges = True
+        self.server.drop_after = 1000
+        self.server.drop_at = 3
+        config['download_part_size'] = '100k'
+        self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        self.assertEqual(self.read(), self.server.data)
+        self.assertGreater(len(self.server.requests), 5)
+        self.assertEqual(self.server.requests[5]['Range'], 'bytes=0-102399')
+
+    def test_short_write(self):
+        api.pwrite = lambda fd, data, offset: pwrite(fd, data[:7777], offset)
+        try:
+            self.assertEqual(self.problem_data(), {'etag': '"1"'})
+        finally:
+            api.pwrite = pwrite
+        self.assertEqual(self.read(), self.server.data)
+
+    def test_parts_changed(self):
+        self.server.ranges = True
+        config['download_part_size'] = '100k'
+        self.server.change_at = 3
+        with self.assertRaisesRegex(Exception, 'changed'):
+            self.problem_data()
+
+class ConsumeTest(TestCase):
+    def setUp(self):
+        self.requests = list()
+        self.received = list()
+        app = web.Application()
+        app.router.add_get('/judge/consume-conn/websocket', self.handle)
+        self.test_server = TestServer(app)
+        run(self.test_server.start_server())
+
+    def tearDown(self):
+        run(self.test_server.close())
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        for judge_request in self.requests:
+            await ws.send_json(judge_request)
+        async for message in ws:
+            self.received.append(message.json())
+        return ws
+
+    def consume(self, handler_type, concurrency, drain=None, started=None):
+        async def consume():
+            async with VJ4Session(str(self.test_server.make_url('/'))) as session:
+                task = get_event_loop().create_task(
+                    session.judge_consume(handler_type, concurrency, drain))
+                if started:
+                    await wait_for(started(session), 5)
+                await wait_for(task, 5)
+        run(consume())
+
+    def test_concurrency(self):
+        self.requests = [{'rid': str(i)} for i in range(4)]
+        running = list()
+        peak = list()
+
+        class Handler:
+            def __init__(self, session, request, ws):
+                self.request, self.ws = request, ws
+
+            async def handle(self):
+                running.append(self.request['rid'])
+                peak.append(len(running))
+                try:
+                    await sleep(0.05)
+                    if self.request['rid'] == '0':
+                        raise Exception('handler failure')
+                    await self.ws.send_json({'rid': self.request['rid']})
+                finally:
+                    running.remove(self.request['rid'])
+
+        drain = Event()
+        async def started(session):
+            while len(self.received) < 3:
+                await sleep(0.01)
+            drain.set()
+        self.consume(Handler, 2, drain, started)
+        self.assertEqual(sorted(message['rid'] for message in self.received), ['1', '2', '3'])
+        self.assertEqual(max(peak), 2)
+
+    def test_fetch_failure(self):
+        self.requests = [{'tag': pid, 'type': 0, 'domain_id': 'system', 'pid': pid,
+                          'rid': pid, 'lang': 'c', 'code': ''} for pid in ('1', '2')]
+
+        async def store_cases(session, domain_id, pid, checkers):
+            if pid == '1':
+                raise ClientPayloadError('truncated')
+            await sleep(0.05)
+            return list()
+
+        class Handler(JudgeHandler):
+            async def build(self):
+                return None
+
+            async def judge(self, cases, package):
+                await self.end(status=STATUS_ACCEPTED, score=100, time_ms=0, memory_kb=0)
+
+        drain = Event()
+        async def started(session):
+            while sum(message['key'] == 'end' for message in self.received) < 2:
+                await sleep(0.01)
+            drain.set()
+        old_store_cases, daemon.store_cases = daemon.store_cases, store_cases
+        try:
+            self.consume(Handler, 2, drain, started)
+        finally:
+            daemon.store_cases = old_store_cases
+        ends = {message['tag']: message['status']
+                for message in self.received if message['key'] == 'end'}
+        self.assertEqual(ends, {'1': STATUS_SYSTEM_ERROR, '2': STATUS_ACCEPTED})
+
+    def test_drain(self):
+        self.requests = [{'rid': str(i)} for i in range(3)]
+        release = Event()
+        drain = Event()
+
+        class Handler:
+            def __init__(self, session, request, ws):
+                self.request, self.ws = request, ws
+
+            async def handle(self):
+                await release.wait()
+                await self.ws.send_json({'rid': self.request['rid']})
+
+        async def started(session):
+            while not session.judge_queue or session.judge_queue.qsize() < 2:
+                await sleep(0.01)
+            drain.set()
+            await sleep(0.05)
+            release.set()
+        self.consume(Handler, 1, drain, started)
+        self.assertEqual(self.received, [{'rid': '0'}])
+
+if __name__ == '__main__':
+    main()
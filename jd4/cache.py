@@ -1,38 +1,200 @@
+import json
 from appdirs import user_cache_dir
 from asyncio import get_event_loop, Event
-from os import makedirs, path, rename, unlink
+from collections import OrderedDict
+from os import listdir, makedirs, path, rename, stat, unlink, utime
+from time import time, time_ns
+
+from jd4.config import config
+from jd4.log import logger
+from jd4.metrics import metrics_timed
+from jd4.util import parse_memory_bytes, read_text_file, write_text_file
 
 _CACHE_DIR = user_cache_dir('jd4')
+DEFAULT_CACHE_SIZE = '8g'
+PARTIAL_MAX_AGE_SEC = 86400
 _events = dict()
+_checkers = dict()
+_failures = dict()
+_remove_callbacks = list()
+_size_callbacks = list()
+_index = None
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'revalidations': 0}
+
+def _unlink(file_path):
+    try:
+        unlink(file_path)
+    except FileNotFoundError:
+        pass
+
+def _size(domain_id, pid, file_path):
+    return stat(file_path).st_size + sum(callback(domain_id, pid)
+                                         for callback in _size_callbacks)
+
+def _load_index():
+    makedirs(_CACHE_DIR, exist_ok=True)
+    entries = list()
+    for domain_id in listdir(_CACHE_DIR):
+        domain_dir = path.join(_CACHE_DIR, domain_id)
+        if domain_id.startswith('.') or not path.isdir(domain_dir):
+            continue
+        for name in listdir(domain_dir):
+            file_path = path.join(domain_dir, name)
+            if not name.endswith('.zip'):
+                continue
+            file_stat = stat(file_path)
+            if name.startswith('tmp_'):
+                # Partial downloads are resumed, unless they are abandoned.
+                if time() - file_stat.st_mtime > PARTIAL_MAX_AGE_SEC:
+                    logger.info('Removing abandoned download %s', file_path)
+                    unlink(file_path)
+                    _unlink(file_path + '.json')
+                continue
+            pid = name[:-4]
+            if pid.startswith('stale_'):
+                pid = pid[6:]
+            entries.append((file_stat.st_atime_ns, domain_id, pid,
+                            _size(domain_id, pid, file_path)))
+    entries.sort()
+    return OrderedDict(((domain_id, pid), size)
+                       for _, domain_id, pid, size in entries)
+
+async def _get_index():
+    global _index
+    if _index is None:
+        index = await get_event_loop().run_in_executor(None, _load_index)
+        if _index is None:
+            _index = index
+            logger.info('Problem data cache: %d entries, %d bytes',
+                        len(_index), sum(_index.values()))
+    return _index
+
+def _touch(file_path):
+    try:
+        utime(file_path, ns=(time_ns(), stat(file_path).st_mtime_ns))
+    except FileNotFoundError:
+        pass
+
+def _remove(domain_id, pid):
+    domain_dir = path.join(_CACHE_DIR, domain_id)
+    for name in (pid + '.zip', 'stale_' + pid + '.zip', pid + '.json'):
+        _unlink(path.join(domain_dir, name))
+    for callback in _remove_callbacks:
+        callback(domain_id, pid)
+
+async def _evict(index):
+    loop = get_event_loop()
+    limit_bytes = parse_memory_bytes(str(config.get('data_cache_size',
+                                                    DEFAULT_CACHE_SIZE)))
+    total_bytes = sum(index.values())
+    while total_bytes > limit_bytes and len(index) > 1:
+        (domain_id, pid), size = index.popitem(last=False)
+        total_bytes -= size
+        _checkers.pop((domain_id, pid), None)
+        _failures.pop((domain_id, pid), None)
+        _stats['evictions'] += 1
+        await loop.run_in_executor(None, _remove, domain_id, pid)
+        logger.debug('Evicted %s/%s', domain_id, pid)
+
+def cache_add_remove_callback(callback):
+    _remove_callbacks.append(callback)
+
+def cache_add_size_callback(callback):
+    """Registers a function returning the bytes kept on disk for a problem
+    besides its data, which count against data_cache_size as well."""
+    _size_callbacks.append(callback)
+
+async def cache_resize(domain_id, pid):
+    """Recounts the size of a cached problem after its derived data changed."""
+    index = await _get_index()
+    if (domain_id, pid) not in index:
+        return
+    file_path = path.join(_CACHE_DIR, domain_id, pid + '.zip')
+    try:
+        size = await get_event_loop().run_in_executor(None, _size, domain_id, pid, file_path)
+    except FileNotFoundError:
+        return
+    if (domain_id, pid) in index:
+        index[(domain_id, pid)] = size
+        await _evict(index)
+
+def cache_stats():
+    return dict(_stats)
+
+def cache_downloading():
+    return len(_events)
 
 async def cache_open(session, domain_id, pid):
+    loop = get_event_loop()
+    index = await _get_index()
     domain_dir = path.join(_CACHE_DIR, domain_id)
     makedirs(domain_dir, exist_ok=True)
     file_path = path.join(domain_dir, pid + '.zip')
+    missed = False
     while True:
         try:
             file = open(file_path, 'rb')
-            return file
         except FileNotFoundError:
             pass
+        else:
+            if not missed:
+                _stats['hits'] += 1
+            if (domain_id, pid) in index:
+                index.move_to_end((domain_id, pid))
+            await loop.run_in_executor(None, _touch, file_path)
+            return file
         event = _events.get((domain_id, pid))
         if not event:
             event = Event()
             _events[(domain_id, pid)] = event
+            _stats['misses'] += 1
+            missed = True
             try:
                 tmp_file_path = path.join(domain_dir, 'tmp_' + pid + '.zip')
-                await session.problem_data(domain_id, pid, tmp_file_path)
-                rename(tmp_file_path, file_path)
+                stale_file_path = path.join(domain_dir, 'stale_' + pid + '.zip')
+                validators_path = path.join(domain_dir, pid + '.json')
+                validators = None
+                if path.exists(stale_file_path):
+                    try:
+                        validators = json.loads(read_text_file(validators_path)) or None
+                    except (FileNotFoundError, ValueError):
+                        pass
+                new_validators = await metrics_timed('fetch', session.problem_data(
+                    domain_id, pid, tmp_file_path, validators))
+                if validators and new_validators is None:
+                    logger.info('Problem data not modified: %s/%s', domain_id, pid)
+                    _stats['revalidations'] += 1
+                    rename(stale_file_path, file_path)
+                else:
+                    rename(tmp_file_path, file_path)
+                    _unlink(stale_file_path)
+                    write_text_file(validators_path, json.dumps(new_validators or {}))
+                size = await loop.run_in_executor(None, _size, domain_id, pid, file_path)
+                # A refetch of stale data is the most recently used entry.
+                index.pop((domain_id, pid), None)
+                index[(domain_id, pid)] = size
+                await _evict(index)
             finally:
                 event.set()
                 del _events[(domain_id, pid)]
         else:
             await event.wait()
 
+def cache_checkers(domain_id, pid):
+    return _checkers.setdefault((domain_id, pid), dict())
+
+def cache_failures(domain_id, pid):
+    return _failures.setdefault((domain_id, pid), dict())
+
 async def cache_invalidate(domain_id, pid):
+    """Marks cached data stale, the next open revalidates it with the server."""
     loop = get_event_loop()
-    file_path = path.join(_CACHE_DIR, domain_id, pid + '.zip')
+    _checkers.pop((domain_id, pid), None)
+    _failures.pop((domain_id, pid), None)
+    await _get_index()
+    domain_dir = path.join(_CACHE_DIR, domain_id)
     try:
-        await loop.run_in_executor(None, unlink, file_path)
+        await loop.run_in_executor(None, rename, path.join(domain_dir, pid + '.zip'),
+                                   path.join(domain_dir, 'stale_' + pid + '.zip'))
     except FileNotFoundError:
         pass
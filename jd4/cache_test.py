@@ -0,0 +1,119 @@
+from asyncio import get_event_loop
+from os import listdir, makedirs, path, utime
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4 import cache
+from jd4.config import config
+from jd4.util import write_binary_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class FakeSession:
+    def __init__(self):
+        self.downloads = list()
+        self.etag = '"1"'
+        self.size = 1000
+
+    async def problem_data(self, domain_id, pid, save_path, validators=None):
+        if validators and validators['etag'] == self.etag:
+            return None
+        self.downloads.append((domain_id, pid))
+        write_binary_file(save_path, b'x' * self.size)
+        return {'etag': self.etag}
+
+class CacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.old_state = cache._CACHE_DIR, cache._index, cache._remove_callbacks, \
+                         cache._size_callbacks, dict(cache._stats), \
+                         config.get('data_cache_size')
+        cache._CACHE_DIR = self.tmp_dir.name
+        cache._index = None
+        cache._remove_callbacks = list()
+        cache._size_callbacks = list()
+        config['data_cache_size'] = 2048
+        self.session = FakeSession()
+
+    def tearDown(self):
+        cache._CACHE_DIR, cache._index, cache._remove_callbacks, \
+            cache._size_callbacks, stats, size = self.old_state
+        cache._stats.update(stats)
+        if size is None:
+            del config['data_cache_size']
+        else:
+            config['data_cache_size'] = size
+        self.tmp_dir.cleanup()
+
+    def open(self, pid):
+        with run(cache.cache_open(self.session, 'system', pid)) as file:
+            return file.read()
+
+    def test_hit_miss(self):
+        stats = cache.cache_stats()
+        self.assertEqual(self.open('1'), b'x' * 1000)
+        self.assertEqual(self.open('1'), b'x' * 1000)
+        self.assertEqual(self.session.downloads, [('system', '1')])
+        self.assertEqual(cache.cache_stats()['misses'], stats['misses'] + 1)
+        self.assertEqual(cache.cache_stats()['hits'], stats['hits'] + 1)
+
+    def test_lru(self):
+        self.open('1')
+        self.open('2')
+        self.open('1')
+        self.open('3')
+        names = listdir(path.join(self.tmp_dir.name, 'system'))
+        self.assertEqual(sorted(name for name in names if name.endswith('.zip')),
+                         ['1.zip', '3.zip'])
+        self.open('1')
+        self.assertEqual(len(self.session.downloads), 3)
+
+    def test_refetch_over_budget(self):
+        self.open('1')
+        self.open('2')
+        run(cache.cache_invalidate('system', '1'))
+        self.session.etag = '"2"'
+        self.session.size = 1100
+        self.assertEqual(self.open('1'), b'x' * 1100)
+        self.assertEqual(self.open('1'), b'x' * 1100)
+        self.assertEqual(self.session.downloads, [('system', '1'), ('system', '2'),
+                                                  ('system', '1')])
+        self.assertEqual(list(cache._index), [('system', '1')])
+
+    def test_size_callback(self):
+        extra = {'1': 0}
+        cache.cache_add_size_callback(lambda domain_id, pid: extra.get(pid, 0))
+        self.open('1')
+        self.open('2')
+        extra['2'] = 500
+        run(cache.cache_resize('system', '2'))
+        self.assertEqual(list(cache._index.items()), [(('system', '2'), 1500)])
+        names = listdir(path.join(self.tmp_dir.name, 'system'))
+        self.assertNotIn('1.zip', names)
+
+    def test_scan(self):
+        domain_dir = path.join(self.tmp_dir.name, 'system')
+        makedirs(domain_dir)
+        write_binary_file(path.join(domain_dir, '1.zip'), b'y')
+        write_binary_file(path.join(domain_dir, 'tmp_2.zip'), b'y')
+        write_binary_file(path.join(domain_dir, 'tmp_3.zip'), b'y')
+        utime(path.join(domain_dir, 'tmp_3.zip'), (0, 0))
+        self.assertEqual(self.open('1'), b'y')
+        self.assertEqual(sorted(listdir(domain_dir)), ['1.zip', 'tmp_2.zip'])
+        self.assertEqual(list(cache._index.items()), [(('system', '1'), 1)])
+
+    def test_revalidate(self):
+        self.open('1')
+        run(cache.cache_invalidate('system', '1'))
+        self.assertEqual(self.open('1'), b'x' * 1000)
+        self.assertEqual(len(self.session.downloads), 1)
+        run(cache.cache_invalidate('system', '1'))
+        self.session.etag = '"2"'
+        self.open('1')
+        self.assertEqual(len(self.session.downloads), 2)
+        self.assertEqual(sorted(listdir(path.join(self.tmp_dir.name, 'system'))),
+                         ['1.json', '1.zip'])
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 import csv
-from asyncio import gather, get_event_loop
+from asyncio import gather, get_event_loop, shield
 from functools import partial
+from hashlib import sha256
 from io import BytesIO, TextIOWrapper
 from itertools import islice
-from os import link, mkfifo, path
+from os import link, mkfifo, path, sendfile
 from ruamel import yaml
 from socket import socket, AF_UNIX, SOCK_STREAM, SOCK_NONBLOCK
 from zipfile import ZipFile
@@ -12,33 +13,51 @@ from jd4._compare import compare_stream
 from jd4.cgroup import wait_cgroup
 from jd4.compile import build
 from jd4.error import FormatError
-from jd4.pool import get_sandbox, put_sandbox
+from jd4.metrics import metrics_timed
+from jd4.pool import get_sandbox, pool_contended_since, pool_contention, put_sandbox
 from jd4.status import STATUS_ACCEPTED, STATUS_WRONG_ANSWER, \
                        STATUS_TIME_LIMIT_EXCEEDED, STATUS_MEMORY_LIMIT_EXCEEDED, \
                        STATUS_RUNTIME_ERROR, STATUS_SYSTEM_ERROR
+from jd4.trace import trace_span, trace_timed
 from jd4.util import read_pipe, parse_memory_bytes, parse_time_ns
 
 CHUNK_SIZE = 32768
+SEND_FILE_SIZE = 1048576
 MAX_STDERR_SIZE = 8192
 DEFAULT_TIME_NS = 1000000000
 DEFAULT_MEMORY_BYTES = 268435456
 PROCESS_LIMIT = 64
 _yaml_safe = yaml.YAML(typ='safe')
 
+class Subtask:
+    """A group of cases scored as the minimum of their scores.
+
+    A subtask is skipped when any subtask it depends on scores zero."""
+    def __init__(self, id, depends):
+        self.id = id
+        self.depends = depends
+
 class CaseBase:
-    def __init__(self, time_limit_ns, memory_limit_bytes, process_limit, score):
+    def __init__(self, time_limit_ns, memory_limit_bytes, process_limit, score,
+                 input_path=None):
         self.time_limit_ns = time_limit_ns
         self.memory_limit_bytes = memory_limit_bytes
         self.process_limit = process_limit
         self.score = score
+        self.input_path = input_path
+        self.subtask = None
 
-    async def judge(self, package):
+    async def judge(self, package, abort=None):
         loop = get_event_loop()
-        sandbox, = await get_sandbox(1)
+        with trace_span('wait'):
+            sandbox, = await get_sandbox(1)
+        contention = pool_contention()
         try:
-            executable = await package.install(sandbox)
+            if abort and abort.done():
+                return None
+            executable = await trace_timed('install', package.install(sandbox))
             stdin_file = path.join(sandbox.in_dir, 'stdin')
-            mkfifo(stdin_file)
+            input_linked = make_input(self.input_path, stdin_file)
             stdout_file = path.join(sandbox.in_dir, 'stdout')
             mkfifo(stdout_file)
             stderr_file = path.join(sandbox.in_dir, 'stderr')
@@ -53,18 +72,26 @@ class CaseBase:
                     stderr_file='/in/stderr',
                     cgroup_file='/in/cgroup'))
                 others_task = gather(
-                    loop.run_in_executor(None, self.do_input, stdin_file),
-                    loop.run_in_executor(None, self.do_output, stdout_file),
+                    trace_timed('input', feed_input(self.do_input, stdin_file, input_linked),
+                                'input'),
+                    trace_timed('output', metrics_timed('output', loop.run_in_executor(
+                        None, self.do_output, stdout_file)), 'output'),
                     read_pipe(stderr_file, MAX_STDERR_SIZE),
                     wait_cgroup(cgroup_sock,
                                 execute_task,
                                 self.time_limit_ns,
                                 self.time_limit_ns,
                                 self.memory_limit_bytes,
-                                self.process_limit))
-                execute_status = await execute_task
+                                self.process_limit,
+                                sandbox,
+                                abort))
+                with trace_span('execute'):
+                    execute_status = await metrics_timed('execute', execute_task)
                 _, correct, stderr, (time_usage_ns, memory_usage_bytes) = \
                     await others_task
+            contended = pool_contended_since(contention)
+            if abort and abort.done():
+                return None
             if memory_usage_bytes >= self.memory_limit_bytes:
                 status = STATUS_MEMORY_LIMIT_EXCEEDED
                 score = 0
@@ -80,7 +107,7 @@ class CaseBase:
             else:
                 status = STATUS_ACCEPTED
                 score = self.score
-            return status, score, time_usage_ns, memory_usage_bytes, stderr
+            return status, score, time_usage_ns, memory_usage_bytes, stderr, contended
         finally:
             put_sandbox(sandbox)
 
@@ -92,16 +119,42 @@ def dos2unix(src, dst):
         buf = buf.replace(b'\r', b'')
         dst.write(buf)
 
+def send_file(src, dst):
+    offset = 0
+    while True:
+        sent = sendfile(dst.fileno(), src.fileno(), offset, SEND_FILE_SIZE)
+        if not sent:
+            break
+        offset += sent
+
+def make_input(input_path, input_file):
+    if input_path:
+        try:
+            link(input_path, input_file)
+            return True
+        except OSError:
+            pass
+    mkfifo(input_file)
+    return False
+
+async def feed_input(do_input, input_file, input_linked):
+    if not input_linked:
+        await get_event_loop().run_in_executor(None, do_input, input_file)
+
 class DefaultCase(CaseBase):
-    def __init__(self, open_input, open_output, time_ns, memory_bytes, score):
-        super().__init__(time_ns, memory_bytes, PROCESS_LIMIT, score)
+    def __init__(self, open_input, open_output, time_ns, memory_bytes, score,
+                 input_path=None):
+        super().__init__(time_ns, memory_bytes, PROCESS_LIMIT, score, input_path)
         self.open_input = open_input
         self.open_output = open_output
 
     def do_input(self, input_file):
         try:
             with open(input_file, 'wb') as dst, self.open_input() as src:
-                dos2unix(src, dst)
+                if self.input_path:
+                    send_file(src, dst)
+                else:
+                    dos2unix(src, dst)
         except BrokenPipeError:
             pass
 
@@ -110,34 +163,51 @@ class DefaultCase(CaseBase):
             return compare_stream(ans, out)
 
 class CustomJudgeCase:
-    def __init__(self, open_input, time_ns, memory_bytes, open_judge, judge_lang):
+    def __init__(self, open_input, time_ns, memory_bytes, open_judge, judge_lang,
+                 checkers, input_path=None):
         self.open_input = open_input
         self.time_ns = time_ns
         self.memory_bytes = memory_bytes
         self.open_judge = open_judge
         self.judge_lang = judge_lang
+        self.checkers = checkers
+        self.input_path = input_path
+        self.subtask = None
 
-    async def judge(self, user_package):
+    async def build_judge(self):
         loop = get_event_loop()
-        judge_package, message, _, _ = await build(
-            self.judge_lang,
-            await loop.run_in_executor(None, lambda: self.open_judge().read()))
-        if not judge_package:
-            return STATUS_SYSTEM_ERROR, 0, 0, 0, message
-        user_sandbox, judge_sandbox = await get_sandbox(2)
+        judge_code = await loop.run_in_executor(
+            None, lambda: self.open_judge().read())
+        key = self.judge_lang, sha256(judge_code).hexdigest()
+        build_task = self.checkers.get(key)
+        if not build_task:
+            build_task = loop.create_task(build(self.judge_lang, judge_code))
+            self.checkers[key] = build_task
         try:
-            async def prepare_user_sandbox():
-                await user_sandbox.reset()
-                return await user_package.install(user_sandbox)
-
-            async def prepare_judge_sandbox():
-                await judge_sandbox.reset()
-                return await judge_package.install(judge_sandbox)
+            return await shield(build_task)
+        except Exception:
+            if self.checkers.get(key) is build_task:
+                del self.checkers[key]
+            raise
 
-            user_executable, judge_executable = \
-                await gather(prepare_user_sandbox(), prepare_judge_sandbox())
+    async def judge(self, user_package, abort=None):
+        loop = get_event_loop()
+        judge_package, message, _, _ = await self.build_judge()
+        if not judge_package:
+            return STATUS_SYSTEM_ERROR, 0, 0, 0, message, False
+        with trace_span('wait'):
+            sandboxes = await get_sandbox(2)
+        contention = pool_contention()
+        user_sandbox, judge_sandbox = sandboxes
+        try:
+            if abort and abort.done():
+                return None
+            with trace_span('install'):
+                user_executable, judge_executable = \
+                    await gather(user_package.install(user_sandbox),
+                                 judge_package.install(judge_sandbox))
             user_stdin_file = path.join(user_sandbox.in_dir, 'stdin')
-            mkfifo(user_stdin_file)
+            user_input_linked = make_input(self.input_path, user_stdin_file)
             user_stdout_file = path.join(user_sandbox.in_dir, 'stdout')
             mkfifo(user_stdout_file)
             judge_stdin_file = path.join(judge_sandbox.in_dir, 'stdin')
@@ -149,7 +219,7 @@ class CustomJudgeCase:
             judge_stderr_file = path.join(judge_sandbox.in_dir, 'stderr')
             mkfifo(judge_stderr_file)
             judge_extra_file = path.join(judge_sandbox.in_dir, 'extra')
-            mkfifo(judge_extra_file)
+            judge_input_linked = make_input(self.input_path, judge_extra_file)
             with socket(AF_UNIX, SOCK_STREAM | SOCK_NONBLOCK) as user_cgroup_sock, \
                  socket(AF_UNIX, SOCK_STREAM | SOCK_NONBLOCK) as judge_cgroup_sock:
                 user_cgroup_sock.bind(path.join(user_sandbox.in_dir, 'cgroup'))
@@ -169,30 +239,43 @@ class CustomJudgeCase:
                     stderr_file='/in/stderr',
                     extra_file='/in/extra',
                     cgroup_file='/in/cgroup'))
-                others_task = gather(
-                    loop.run_in_executor(None, self.do_input, user_stdin_file),
-                    loop.run_in_executor(None, self.do_input, judge_extra_file),
+                user_task = gather(
+                    trace_timed('execute', metrics_timed('execute', user_execute_task)),
+                    trace_timed('input', feed_input(
+                        self.do_input, user_stdin_file, user_input_linked), 'input'),
                     read_pipe(user_stderr_file, MAX_STDERR_SIZE),
-                    read_pipe(judge_stdout_file, MAX_STDERR_SIZE),
-                    read_pipe(judge_stderr_file, MAX_STDERR_SIZE),
                     wait_cgroup(user_cgroup_sock,
                                 user_execute_task,
                                 self.time_ns,
                                 self.time_ns,
                                 self.memory_bytes,
-                                PROCESS_LIMIT),
+                                PROCESS_LIMIT,
+                                user_sandbox,
+                                abort))
+                judge_task = gather(
+                    trace_timed('judge', metrics_timed('judge', judge_execute_task), 'judge'),
+                    trace_timed('input', feed_input(
+                        self.do_input, judge_extra_file, judge_input_linked), 'judge input'),
+                    read_pipe(judge_stdout_file, MAX_STDERR_SIZE),
+                    read_pipe(judge_stderr_file, MAX_STDERR_SIZE),
                     wait_cgroup(judge_cgroup_sock,
                                 judge_execute_task,
                                 DEFAULT_TIME_NS,
                                 self.time_ns + DEFAULT_TIME_NS,
                                 DEFAULT_MEMORY_BYTES,
-                                PROCESS_LIMIT))
-                user_execute_status, judge_execute_status = await gather(
-                    user_execute_task, judge_execute_task)
-                _, _, user_stderr, judge_stdout, judge_stderr, \
-                (user_time_usage_ns, user_memory_usage_bytes), \
-                (judge_time_usage_ns, judge_memory_usage_bytes) = \
-                    await others_task
+                                PROCESS_LIMIT,
+                                judge_sandbox,
+                                abort))
+                user_execute_status, _, user_stderr, \
+                (user_time_usage_ns, user_memory_usage_bytes) = await user_task
+                contended = pool_contended_since(contention)
+                # The judge may still be working, let others use the user sandbox.
+                sandboxes.remove(user_sandbox)
+                put_sandbox(user_sandbox)
+                judge_execute_status, _, judge_stdout, judge_stderr, \
+                (judge_time_usage_ns, judge_memory_usage_bytes) = await judge_task
+            if abort and abort.done():
+                return None
             if (judge_execute_status or
                 judge_memory_usage_bytes >= DEFAULT_MEMORY_BYTES or
                 judge_time_usage_ns >= DEFAULT_TIME_NS):
@@ -213,14 +296,18 @@ class CustomJudgeCase:
                 except SystemError:
                     status = STATUS_SYSTEM_ERROR
                     score = 0
-            return status, score, user_time_usage_ns, user_memory_usage_bytes, user_stderr
+            return status, score, user_time_usage_ns, user_memory_usage_bytes, user_stderr, \
+                   contended
         finally:
-            put_sandbox(user_sandbox, judge_sandbox)
+            put_sandbox(*sandboxes)
 
     def do_input(self, input_file):
         try:
             with open(input_file, 'wb') as dst, self.open_input() as src:
-                dos2unix(src, dst)
+                if self.input_path:
+                    send_file(src, dst)
+                else:
+                    dos2unix(src, dst)
         except BrokenPipeError:
             pass
 
@@ -255,22 +342,49 @@ def read_legacy_cases(config, open):
                           memory_bytes,
                           int(score_str))
 
-def read_yaml_cases(config, open):
-    for case in _yaml_safe.load(config)['cases']:
-        if 'judge' not in case:
-            yield DefaultCase(partial(open, case['input']),
-                              partial(open, case['output']),
-                              parse_time_ns(case['time']),
-                              parse_memory_bytes(case['memory']),
-                              int(case['score']))
-        else:
-            yield CustomJudgeCase(partial(open, case['input']),
-                                  parse_time_ns(case['time']),
-                                  parse_memory_bytes(case['memory']),
-                                  partial(open, case['judge']),
-                                  path.splitext(case['judge'])[1][1:])
+def _read_yaml_case(case, open, checkers, score=None):
+    if 'judge' not in case:
+        score = case.get('score', score)
+        if score is None:
+            raise FormatError('case has no score', case['input'])
+        return DefaultCase(partial(open, case['input']),
+                           partial(open, case['output']),
+                           parse_time_ns(case['time']),
+                           parse_memory_bytes(case['memory']),
+                           int(score))
+    else:
+        return CustomJudgeCase(partial(open, case['input']),
+                               parse_time_ns(case['time']),
+                               parse_memory_bytes(case['memory']),
+                               partial(open, case['judge']),
+                               path.splitext(case['judge'])[1][1:],
+                               checkers)
+
+def read_yaml_cases(config, open, checkers):
+    config = _yaml_safe.load(config)
+    for case in config.get('cases', ()):
+        yield _read_yaml_case(case, open, checkers)
+    subtask_ids = set()
+    for index, subtask_config in enumerate(config.get('subtasks', ())):
+        subtask = Subtask(subtask_config.get('id', index + 1),
+                          list(subtask_config.get('depends', ())))
+        if subtask.id in subtask_ids:
+            raise FormatError('duplicate subtask', subtask.id)
+        for depend in subtask.depends:
+            if depend not in subtask_ids:
+                raise FormatError('subtask must depend on an earlier subtask',
+                                  subtask.id, depend)
+        if not subtask_config.get('cases'):
+            raise FormatError('subtask has no cases', subtask.id)
+        subtask_ids.add(subtask.id)
+        for case_config in subtask_config['cases']:
+            case = _read_yaml_case(case_config, open, checkers, subtask_config.get('score'))
+            case.subtask = subtask
+            yield case
 
-def read_cases(file):
+def read_cases(file, checkers=None):
+    if checkers is None:
+        checkers = dict()
     zip_file = ZipFile(file)
     canonical_dict = dict((name.lower(), name)
                           for name in zip_file.namelist())
@@ -288,7 +402,7 @@ def read_cases(file):
         pass
     try:
         config = open('config.yaml')
-        return read_yaml_cases(config, open)
+        return read_yaml_cases(config, open, checkers)
     except FileNotFoundError:
         pass
     raise FormatError('config file not found')
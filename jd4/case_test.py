@@ -1,7 +1,18 @@
-from os import path
+from asyncio import gather, get_event_loop, sleep, wait_for
+from io import BytesIO
+from os import makedirs, path
+from tempfile import TemporaryDirectory, TemporaryFile
 from unittest import main, TestCase
+from zipfile import ZipFile
 
-from jd4.case import read_cases
+from jd4 import case
+from jd4.case import CustomJudgeCase, read_cases, send_file
+from jd4.error import FormatError
+from jd4.status import STATUS_ACCEPTED
+from jd4.util import write_binary_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
 
 class CaseTest(TestCase):
     def test_legacy_case(self):
@@ -30,5 +41,140 @@ class CaseTest(TestCase):
                 count += 1
         self.assertEqual(count, 10)
 
+    def test_subtask_case(self):
+        with open(path.join(path.dirname(__file__),
+                            'testdata/aplusb-subtask.zip'), 'rb') as file:
+            cases = list(read_cases(file))
+        self.assertEqual([case.subtask.id for case in cases],
+                         [1] * 3 + [2] * 3 + ['last'] * 4)
+        self.assertEqual([case.score for case in cases], [20] * 3 + [30] * 3 + [50] * 4)
+        self.assertEqual(cases[9].subtask.depends, [1, 2])
+        self.assertIs(cases[6].subtask, cases[9].subtask)
+
+    def read_config(self, config):
+        file = BytesIO()
+        with ZipFile(file, 'w') as zip_file:
+            zip_file.writestr('config.yaml', config)
+        return list(read_cases(file))
+
+    def test_subtask_format_error(self):
+        case = "{input: 1.in, output: 1.out, time: 1s, memory: 16m}"
+        with self.assertRaisesRegex(FormatError, 'no score'):
+            self.read_config('subtasks: [{cases: [' + case + ']}]')
+        with self.assertRaisesRegex(FormatError, 'no cases'):
+            self.read_config('subtasks: [{score: 10}]')
+        cases = self.read_config('subtasks: [{score: 10, cases: [' + case + ']}]')
+        self.assertEqual([case.score for case in cases], [10])
+
+    def test_send_file(self):
+        data = b'1 2\n' * 1048576
+        with TemporaryFile() as src, TemporaryFile() as dst:
+            src.write(data)
+            src.flush()
+            send_file(src, dst)
+            dst.seek(0)
+            self.assertEqual(dst.read(), data)
+
+class FakeSandbox:
+    def __init__(self, in_dir):
+        self.in_dir = in_dir
+
+def _write_fifo(file_path, data):
+    with open(file_path, 'wb') as file:
+        file.write(data)
+
+class FakeExecutable:
+    def __init__(self, run):
+        self.run = run
+
+    async def execute(self, sandbox, **kwargs):
+        return await self.run(sandbox)
+
+class FakePackage:
+    def __init__(self, run):
+        self.run = run
+
+    async def install(self, sandbox):
+        return FakeExecutable(self.run)
+
+class CustomJudgeTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.builds = list()
+        self.released = list()
+        self.patched = case.build, case.get_sandbox, case.put_sandbox, case.wait_cgroup
+        case.build = self.build
+        case.get_sandbox = self.get_sandbox
+        case.put_sandbox = lambda *sandboxes: self.released.extend(sandboxes)
+        case.wait_cgroup = self.wait_cgroup
+
+    def tearDown(self):
+        case.build, case.get_sandbox, case.put_sandbox, case.wait_cgroup = self.patched
+        self.tmp_dir.cleanup()
+
+    async def build(self, lang, code):
+        self.builds.append((lang, code))
+        await sleep(0.01)
+        if code == b'bad':
+            raise Exception('build failed')
+        return FakePackage(self.run_judge), b'', 0, 0
+
+    async def get_sandbox(self, n):
+        sandboxes = list()
+        for index in range(n):
+            in_dir = path.join(self.tmp_dir.name, str(index))
+            makedirs(in_dir, exist_ok=True)
+            sandboxes.append(FakeSandbox(in_dir))
+        self.sandboxes = sandboxes
+        return list(sandboxes)
+
+    async def wait_cgroup(self, sock, execute_task, *args):
+        await execute_task
+        return 1000, 1024
+
+    async def run_user(self, sandbox):
+        await get_event_loop().run_in_executor(
+            None, _write_fifo, path.join(sandbox.in_dir, 'stderr'), b'')
+        return 0
+
+    async def run_judge(self, sandbox):
+        # Only answers once the user sandbox is back in the pool.
+        while self.sandboxes[0] not in self.released:
+            await sleep(0.01)
+        loop = get_event_loop()
+        await gather(
+            loop.run_in_executor(None, _write_fifo, path.join(sandbox.in_dir, 'stdout'),
+                                 '{} 100\n'.format(STATUS_ACCEPTED).encode()),
+            loop.run_in_executor(None, _write_fifo, path.join(sandbox.in_dir, 'stderr'), b''))
+        return 0
+
+    def case(self, checkers, judge_code=b'checker'):
+        input_path = path.join(self.tmp_dir.name, 'input')
+        write_binary_file(input_path, b'1 2\n')
+        return CustomJudgeCase(lambda: BytesIO(b'1 2\n'), 1000000000, 268435456,
+                               lambda: BytesIO(judge_code), 'cc', checkers, input_path)
+
+    def test_checker_shared(self):
+        checkers = dict()
+        results = run(gather(self.case(checkers).build_judge(),
+                             self.case(checkers).build_judge()))
+        run(self.case(checkers).build_judge())
+        self.assertEqual(len(self.builds), 1)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(len(checkers), 1)
+
+    def test_checker_failed(self):
+        checkers = dict()
+        for _ in range(2):
+            with self.assertRaisesRegex(Exception, 'build failed'):
+                run(self.case(checkers, b'bad').build_judge())
+        self.assertEqual(len(self.builds), 2)
+        self.assertFalse(checkers)
+
+    def test_user_sandbox_released(self):
+        result = run(wait_for(self.case(dict()).judge(FakePackage(self.run_user)), 5))
+        self.assertEqual(result[:4], (STATUS_ACCEPTED, 100, 1000, 1024))
+        self.assertEqual(self.released, self.sandboxes)
+
 if __name__ == '__main__':
     main()
@@ -1,6 +1,8 @@
-from asyncio import get_event_loop, shield, sleep, wait_for, TimeoutError
-from itertools import chain
-from os import access, cpu_count, geteuid, getpid, kill, makedirs, path, rmdir, W_OK
+from asyncio import get_event_loop, sleep, Event
+from os import access, close as os_close, cpu_count, geteuid, getpid, kill, makedirs, \
+               open as os_open, path, pread, rmdir, sched_getaffinity, sched_setaffinity, \
+               write, O_RDONLY, O_RDWR, W_OK
+from select import epoll, EPOLLPRI
 from signal import SIGKILL
 from socket import socket, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_PEERCRED
 from subprocess import call
@@ -10,9 +12,17 @@ from tempfile import mkdtemp
 from jd4.log import logger
 from jd4.util import read_text_file, write_text_file
 
+try:
+    from os import pidfd_open
+except ImportError:
+    pidfd_open = None
+
 CGROUP2_ROOT = '/sys/fs/cgroup/jd4'
 CGROUP2_DAEMON_ROOT = path.join(CGROUP2_ROOT, 'daemon')
-WAIT_JITTER_NS = 5000000
+CPU_TOPOLOGY_DIR = '/sys/devices/system/cpu'
+MIN_WAIT_NS = 1000000
+MAX_RESIDUAL_BYTES = 1048576
+_PREAD_SIZE = 4096
 
 def try_init_cgroup():
     euid = geteuid()
@@ -36,6 +46,7 @@ def try_init_cgroup():
                 euid, CGROUP2_ROOT, cgroup2_subtree_control, CGROUP2_DAEMON_ROOT)])
         else:
             logger.error('Cgroup not initialized')
+    _enable_cpuset(euid)
 
     # Put myself into the cgroup that I can write.
     pid = getpid()
@@ -49,19 +60,200 @@ def try_init_cgroup():
     else:
         logger.error('Cgroup not entered')
 
+def _enable_cpuset(euid):
+    # Also done on an existing hierarchy, which may predate cpu pinning.
+    cgroup2_subtree_control = path.join(CGROUP2_ROOT, 'cgroup.subtree_control')
+    try:
+        if 'cpuset' in read_text_file(cgroup2_subtree_control).split():
+            return
+    except FileNotFoundError:
+        return
+    root_subtree_control = path.join(path.dirname(CGROUP2_ROOT), 'cgroup.subtree_control')
+    logger.info('Enabling cpuset controller: %s', CGROUP2_ROOT)
+    if euid == 0:
+        try:
+            write_text_file(root_subtree_control, '+cpuset')
+            write_text_file(cgroup2_subtree_control, '+cpuset')
+        except OSError:
+            logger.warning('Cpuset controller not available')
+    elif __stdin__.isatty():
+        if call(['sudo', 'sh', '-c', 'echo "+cpuset" > "{0}" && echo "+cpuset" > "{1}"'.format(
+                root_subtree_control, cgroup2_subtree_control)]):
+            logger.warning('Cpuset controller not available')
+
+def _parse_cpu_list(text):
+    cpus = list()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _format_cpu_list(cpus):
+    return ','.join(map(str, sorted(cpus)))
+
+def _read_cores():
+    allowed = sched_getaffinity(0)
+    cores = list()
+    for cpu in sorted(allowed):
+        try:
+            siblings = _parse_cpu_list(read_text_file(path.join(
+                CPU_TOPOLOGY_DIR, 'cpu{}'.format(cpu), 'topology', 'thread_siblings_list')))
+        except FileNotFoundError:
+            siblings = [cpu]
+        core = tuple(sibling for sibling in siblings if sibling in allowed)
+        if core not in cores:
+            cores.append(core)
+    return cores
+
+def _assign_cpus(cores, n, daemon_cores):
+    """Assigns cores to the daemon and n sandbox slots.
+
+    The daemon gets all threads of its reserved cores. Each slot gets one
+    thread of a dedicated core, SMT siblings are used only when there are
+    more slots than cores, and slots share CPUs beyond that."""
+    if len(cores) <= daemon_cores:
+        daemon_cores = 0
+    daemon_cpus = [cpu for core in cores[:daemon_cores] for cpu in core]
+    cores = cores[daemon_cores:]
+    cpus = list()
+    for i in range(max(map(len, cores))):
+        cpus.extend(core[i] for core in cores if i < len(core))
+    return daemon_cpus, [[cpus[i % len(cpus)]] for i in range(n)]
+
+def pin_cpus(n, daemon_cores):
+    """Pins the daemon to its reserved cores and returns the CPUs of each slot."""
+    try:
+        controllers = read_text_file(
+            path.join(CGROUP2_ROOT, 'cgroup.subtree_control')).split()
+    except FileNotFoundError:
+        controllers = list()
+    if 'cpuset' not in controllers:
+        logger.warning('Cpuset controller not enabled, CPU pinning disabled')
+        return [None] * n
+    cores = _read_cores()
+    if n + daemon_cores > len(cores):
+        logger.warning('%d sandboxes and %d daemon cores on %d physical cores, '
+                       'sandboxes will share cores', n, daemon_cores, len(cores))
+    daemon_cpus, slot_cpus = _assign_cpus(cores, n, daemon_cores)
+    if daemon_cpus:
+        logger.info('Pinning daemon to CPUs %s', _format_cpu_list(daemon_cpus))
+        write_text_file(path.join(CGROUP2_DAEMON_ROOT, 'cpuset.cpus'),
+                        _format_cpu_list(daemon_cpus))
+        sched_setaffinity(0, daemon_cpus)
+    return [_format_cpu_list(cpus) for cpus in slot_cpus]
+
+def read_pressure(resource):
+    """Returns the 10 second average of some pressure of the jd4 cgroup in percent."""
+    try:
+        line = read_text_file(path.join(CGROUP2_ROOT, resource + '.pressure')).splitlines()[0]
+    except OSError:
+        return 0.
+    return float(line.split()[1].partition('=')[2])
+
 class CGroup:
-    def __init__(self):
+    def __init__(self, cpus=None):
         self.cgroup2_dir = mkdtemp(prefix='', dir=CGROUP2_ROOT)
+        if cpus:
+            write_text_file(path.join(self.cgroup2_dir, 'cpuset.cpus'), cpus)
+        self.cpu_stat_fd = self._open('cpu.stat')
+        try:
+            self.memory_peak_fd = self._open('memory.peak', O_RDWR)
+            self.reusable = True
+        except OSError:
+            self.memory_peak_fd = self._open('memory.peak')
+            self.reusable = False
+        self.memory_events_fd = self._open('memory.events')
+        self.cgroup_events_fd = self._open('cgroup.events')
+        self.pidfd = None
+        self.exited = False
+        self.cpu_base_ns = 0
+        self.oom_kill_base = 0
+
+    def _open(self, name, flags=O_RDONLY):
+        return os_open(path.join(self.cgroup2_dir, name), flags)
 
     def close(self):
+        self.close_pidfd()
+        for fd in (self.cpu_stat_fd, self.memory_peak_fd, self.memory_events_fd,
+                   self.cgroup_events_fd):
+            os_close(fd)
         rmdir(self.cgroup2_dir)
 
-    async def accept(self, sock):
-        loop = get_event_loop()
-        accept_sock, _ = await loop.sock_accept(sock)
+    def close_pidfd(self):
+        if self.pidfd is not None:
+            os_close(self.pidfd)
+            self.pidfd = None
+
+    def reset(self):
+        """Prepares an empty cgroup for the next run.
+
+        Must be called after the sandbox is reset, so memory of the previous
+        run such as its tmpfs pages is released. Returns False if the kernel
+        cannot reset memory.peak or memory is still charged, in which case
+        the cgroup should be closed instead."""
+        if not self.reusable:
+            return False
+        current_path = path.join(self.cgroup2_dir, 'memory.current')
+        current_bytes = int(read_text_file(current_path))
+        if current_bytes:
+            try:
+                write_text_file(path.join(self.cgroup2_dir, 'memory.reclaim'),
+                                str(current_bytes))
+            except OSError as e:
+                logger.warning('Failed to reclaim %d bytes of %s: %r',
+                               current_bytes, self.cgroup2_dir, e)
+            current_bytes = int(read_text_file(current_path))
+        if current_bytes > MAX_RESIDUAL_BYTES:
+            logger.warning('%d bytes left in %s, not reusing it',
+                           current_bytes, self.cgroup2_dir)
+            return False
+        try:
+            write(self.memory_peak_fd, b'reset')
+        except OSError:
+            self.reusable = False
+            return False
+        self.cpu_base_ns = 0
+        self.cpu_base_ns = self.cpu_usage_ns
+        self.oom_kill_base = _read_keyed(self.memory_events_fd)[b'oom_kill']
+        return True
+
+    def enter(self, accept_sock):
         pid = accept_sock.getsockopt(SOL_SOCKET, SO_PEERCRED)
         write_text_file(path.join(self.cgroup2_dir, 'cgroup.procs'), str(pid))
-        accept_sock.close()
+        if pidfd_open:
+            self.pidfd = pidfd_open(pid)
+
+    def watch(self, callback):
+        """Calls callback when the main process exits or the cgroup events change.
+
+        Returns a function that stops watching."""
+        loop = get_event_loop()
+        events = epoll()
+        events.register(self.memory_events_fd, EPOLLPRI)
+        events.register(self.cgroup_events_fd, EPOLLPRI)
+
+        def on_events():
+            events.poll(0)
+            callback()
+
+        def on_exit():
+            loop.remove_reader(self.pidfd)
+            self.exited = True
+            callback()
+
+        loop.add_reader(events.fileno(), on_events)
+        if self.pidfd is not None:
+            loop.add_reader(self.pidfd, on_exit)
+
+        def unwatch():
+            loop.remove_reader(events.fileno())
+            if self.pidfd is not None:
+                loop.remove_reader(self.pidfd)
+            events.close()
+
+        return unwatch
 
     @property
     def procs(self):
@@ -82,8 +274,16 @@ class CGroup:
 
     @property
     def cpu_usage_ns(self):
-        return 1000 * int(read_text_file(path.join(self.cgroup2_dir, 'cpu.stat'))
-                          .splitlines()[0].split()[1])
+        return 1000 * int(pread(self.cpu_stat_fd, _PREAD_SIZE, 0)
+                          .splitlines()[0].split()[1]) - self.cpu_base_ns
+
+    @property
+    def populated(self):
+        return _read_keyed(self.cgroup_events_fd)[b'populated'] != 0
+
+    @property
+    def oom_killed(self):
+        return _read_keyed(self.memory_events_fd)[b'oom_kill'] > self.oom_kill_base
 
     @property
     def memory_limit_bytes(self):
@@ -95,7 +295,7 @@ class CGroup:
 
     @property
     def memory_usage_bytes(self):
-        return int(read_text_file(path.join(self.cgroup2_dir, 'memory.peak')))
+        return int(pread(self.memory_peak_fd, _PREAD_SIZE, 0))
 
     @property
     def pids_max(self):
@@ -110,34 +310,77 @@ def enter_cgroup(socket_path):
         sock.connect(socket_path)
         sock.recv(1)
 
-def _get_idle():
-    return float(read_text_file('/proc/uptime').split()[1])
+def _read_keyed(fd):
+    return dict((key, int(value)) for key, value in
+                (line.split() for line in pread(fd, _PREAD_SIZE, 0).splitlines()))
+
+def _get_idle(uptime_fd):
+    return float(pread(uptime_fd, _PREAD_SIZE, 0).split()[1])
 
 async def wait_cgroup(sock, execute_task, cpu_limit_ns, idle_limit_ns,
-                      memory_limit_bytes, process_limit):
-    cgroup = CGroup()
+                      memory_limit_bytes, process_limit, sandbox=None, abort=None):
+    loop = get_event_loop()
+    cgroup = None
+    uptime_fd = os_open('/proc/uptime', O_RDONLY)
+    changed = Event()
+    unwatch = None
+    on_abort = lambda _: changed.set()
+    if abort:
+        abort.add_done_callback(on_abort)
     try:
-        cgroup.memory_limit_bytes = memory_limit_bytes
-        cgroup.pids_max = process_limit
-        await cgroup.accept(sock)
-        start_idle = _get_idle()
+        accept_sock, _ = await loop.sock_accept(sock)
+        # The sandbox runs its reset before the process connects, so the
+        # previous run is fully released by now.
+        cgroup = sandbox and sandbox.cgroup
+        if cgroup and not cgroup.reset():
+            sandbox.cgroup = None
+            cgroup.close()
+            cgroup = None
+        if not cgroup:
+            cgroup = CGroup(sandbox and sandbox.cpus)
+        with accept_sock:
+            cgroup.memory_limit_bytes = memory_limit_bytes
+            cgroup.pids_max = process_limit
+            cgroup.enter(accept_sock)
+        start_idle = _get_idle(uptime_fd)
+        unwatch = cgroup.watch(changed.set)
+        execute_task.add_done_callback(lambda _: changed.set())
 
         while True:
+            changed.clear()
+            if (cgroup.exited or execute_task.done() or (abort and abort.done()) or
+                not cgroup.populated or cgroup.oom_killed):
+                break
             cpu_usage_ns = cgroup.cpu_usage_ns
             cpu_remain_ns = cpu_limit_ns - cpu_usage_ns
             if cpu_remain_ns <= 0:
                 return cpu_usage_ns, cgroup.memory_usage_bytes
-            idle_usage_ns = int((_get_idle() - start_idle) / cpu_count() * 1e9)
+            idle_usage_ns = int((_get_idle(uptime_fd) - start_idle) / cpu_count() * 1e9)
             idle_remain_ns = idle_limit_ns - idle_usage_ns
             if idle_remain_ns <= 0:
                 return idle_usage_ns, cgroup.memory_usage_bytes
-            try:
-                await wait_for(shield(execute_task),
-                               (min(cpu_remain_ns, idle_remain_ns) + WAIT_JITTER_NS) / 1e9)
-                return cgroup.cpu_usage_ns, cgroup.memory_usage_bytes
-            except TimeoutError:
-                pass
+            timer = loop.call_later(
+                max(min(cpu_remain_ns, idle_remain_ns), MIN_WAIT_NS) / 1e9, changed.set)
+            await changed.wait()
+            timer.cancel()
+        memory_usage_bytes = cgroup.memory_usage_bytes
+        if cgroup.oom_killed:
+            memory_usage_bytes = max(memory_usage_bytes, memory_limit_bytes)
+        return cgroup.cpu_usage_ns, memory_usage_bytes
     finally:
-        while cgroup.kill():
-            await sleep(.001)
-        cgroup.close()
+        if abort:
+            abort.remove_done_callback(on_abort)
+        if unwatch:
+            unwatch()
+        os_close(uptime_fd)
+        if cgroup:
+            while cgroup.kill():
+                await sleep(.001)
+            cgroup.close_pidfd()
+            cgroup.exited = False
+            if sandbox and cgroup.reusable:
+                sandbox.cgroup = cgroup
+            else:
+                if sandbox:
+                    sandbox.cgroup = None
+                cgroup.close()
@@ -0,0 +1,225 @@
+from asyncio import get_event_loop, open_unix_connection, sleep
+from os import close, makedirs, path, O_RDWR
+from socket import socket, AF_UNIX, SOCK_STREAM, SOCK_NONBLOCK
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4 import cgroup
+from jd4.cgroup import _assign_cpus, _enable_cpuset, _format_cpu_list, _parse_cpu_list, \
+                       pin_cpus, read_pressure, wait_cgroup, CGroup
+from jd4.util import read_text_file, write_text_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class CpuListTest(TestCase):
+    def test_parse(self):
+        self.assertEqual(_parse_cpu_list('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(_parse_cpu_list('5'), [5])
+
+    def test_format(self):
+        self.assertEqual(_format_cpu_list([4, 0]), '0,4')
+
+class AssignCpusTest(TestCase):
+    def test_dedicated(self):
+        cores = [(0, 4), (1, 5), (2, 6), (3, 7)]
+        self.assertEqual(_assign_cpus(cores, 3, 1), ([0, 4], [[1], [2], [3]]))
+
+    def test_siblings(self):
+        cores = [(0, 4), (1, 5), (2, 6), (3, 7)]
+        self.assertEqual(_assign_cpus(cores, 5, 1), ([0, 4], [[1], [2], [3], [5], [6]]))
+
+    def test_shared(self):
+        cores = [(0,), (1,), (2,)]
+        self.assertEqual(_assign_cpus(cores, 3, 1), ([0], [[1], [2], [1]]))
+
+    def test_no_daemon_core(self):
+        self.assertEqual(_assign_cpus([(0, 1)], 2, 1), ([], [[0], [1]]))
+
+class PressureTest(TestCase):
+    def test_read(self):
+        with TemporaryDirectory() as tmp_dir:
+            old_root, cgroup.CGROUP2_ROOT = cgroup.CGROUP2_ROOT, tmp_dir
+            try:
+                write_text_file(path.join(tmp_dir, 'cpu.pressure'),
+                                'some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n'
+                                'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+                self.assertEqual(read_pressure('cpu'), 12.5)
+                self.assertEqual(read_pressure('memory'), 0.)
+            finally:
+                cgroup.CGROUP2_ROOT = old_root
+
+class CpusetTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.old_root = cgroup.CGROUP2_ROOT
+        cgroup.CGROUP2_ROOT = path.join(self.tmp_dir.name, 'jd4')
+        makedirs(cgroup.CGROUP2_ROOT)
+        self.root_file = path.join(self.tmp_dir.name, 'cgroup.subtree_control')
+        self.jd4_file = path.join(cgroup.CGROUP2_ROOT, 'cgroup.subtree_control')
+        write_text_file(self.root_file, 'cpu memory pids\n')
+
+    def tearDown(self):
+        cgroup.CGROUP2_ROOT = self.old_root
+        self.tmp_dir.cleanup()
+
+    def test_enable_existing(self):
+        write_text_file(self.jd4_file, 'cpu memory pids\n')
+        self.assertEqual(pin_cpus(2, 1), [None, None])
+        _enable_cpuset(0)
+        self.assertEqual(read_text_file(self.root_file), '+cpuset')
+        self.assertEqual(read_text_file(self.jd4_file), '+cpuset')
+
+    def test_enabled(self):
+        write_text_file(self.jd4_file, 'cpuset cpu memory pids\n')
+        _enable_cpuset(0)
+        self.assertEqual(read_text_file(self.root_file), 'cpu memory pids\n')
+
+class ResetTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        for name, text in (('cpu.stat', 'usage_usec 5000\n'),
+                           ('memory.peak', '8192\n'),
+                           ('memory.events', 'oom 1\noom_kill 1\n'),
+                           ('memory.current', '4096\n'),
+                           ('memory.reclaim', '')):
+            write_text_file(path.join(self.tmp_dir.name, name), text)
+        self.cgroup = CGroup.__new__(CGroup)
+        self.cgroup.cgroup2_dir = self.tmp_dir.name
+        self.cgroup.cpu_base_ns = 0
+        self.cgroup.reusable = True
+        self.cgroup.cpu_stat_fd = self.cgroup._open('cpu.stat')
+        self.cgroup.memory_peak_fd = self.cgroup._open('memory.peak', O_RDWR)
+        self.cgroup.memory_events_fd = self.cgroup._open('memory.events')
+
+    def tearDown(self):
+        for fd in (self.cgroup.cpu_stat_fd, self.cgroup.memory_peak_fd,
+                   self.cgroup.memory_events_fd):
+            close(fd)
+        self.tmp_dir.cleanup()
+
+    def read(self, name):
+        return read_text_file(path.join(self.tmp_dir.name, name))
+
+    def test_reset(self):
+        self.assertTrue(self.cgroup.reset())
+        self.assertEqual(self.read('memory.reclaim'), '4096')
+        self.assertTrue(self.read('memory.peak').startswith('reset'))
+        self.assertEqual(self.cgroup.cpu_usage_ns, 0)
+        self.assertFalse(self.cgroup.oom_killed)
+
+    def test_residual(self):
+        write_text_file(path.join(self.tmp_dir.name, 'memory.current'), '16777216\n')
+        self.assertFalse(self.cgroup.reset())
+        self.assertEqual(self.read('memory.peak'), '8192\n')
+
+    def test_not_reusable(self):
+        self.cgroup.reusable = False
+        self.assertFalse(self.cgroup.reset())
+        self.assertEqual(self.read('memory.reclaim'), '')
+
+class FakeCGroup:
+    """Stands in for a cgroup, cpu time advances with the wall clock."""
+    def __init__(self):
+        self.reusable = True
+        self.exited = False
+        self.populated = True
+        self.oom_killed = False
+        self.memory_usage_bytes = 4096
+        self.callback = None
+        self.entered = False
+        self.closed = False
+        self.start = get_event_loop().time()
+
+    def reset(self):
+        return True
+
+    def enter(self, accept_sock):
+        self.entered = True
+
+    def watch(self, callback):
+        self.callback = callback
+        return lambda: None
+
+    def kill(self):
+        return False
+
+    def close_pidfd(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    @property
+    def cpu_usage_ns(self):
+        return int((get_event_loop().time() - self.start) * 1e9)
+
+class FakeSandbox:
+    def __init__(self, cgroup):
+        self.cgroup = cgroup
+        self.cpus = None
+
+class WaitCGroupTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.cgroup = FakeCGroup()
+        self.sandbox = FakeSandbox(self.cgroup)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def wait(self, event, cpu_limit_ns=10 ** 10, memory_limit_bytes=65536):
+        loop = get_event_loop()
+
+        async def test():
+            socket_path = path.join(self.tmp_dir.name, 'cgroup')
+            with socket(AF_UNIX, SOCK_STREAM | SOCK_NONBLOCK) as sock:
+                sock.bind(socket_path)
+                sock.listen()
+                execute_task = loop.create_future()
+                wait_task = loop.create_task(wait_cgroup(
+                    sock, execute_task, cpu_limit_ns, cpu_limit_ns * 100,
+                    memory_limit_bytes, 64, self.sandbox))
+                _, writer = await open_unix_connection(socket_path)
+                await sleep(0.01)
+                self.assertTrue(self.cgroup.entered)
+                if event:
+                    event()
+                    self.cgroup.callback()
+                result = await wait_task
+                writer.close()
+                return result
+
+        return run(test())
+
+    def test_exit(self):
+        def exit():
+            self.cgroup.exited = True
+        cpu_usage_ns, memory_usage_bytes = self.wait(exit)
+        self.assertLess(cpu_usage_ns, 10 ** 9)
+        self.assertEqual(memory_usage_bytes, 4096)
+        self.assertIs(self.sandbox.cgroup, self.cgroup)
+        self.assertFalse(self.cgroup.closed)
+
+    def test_oom(self):
+        def oom():
+            self.cgroup.oom_killed = True
+            self.cgroup.populated = False
+        _, memory_usage_bytes = self.wait(oom)
+        self.assertEqual(memory_usage_bytes, 65536)
+
+    def test_timeout(self):
+        cpu_usage_ns, _ = self.wait(None, cpu_limit_ns=50000000)
+        self.assertGreaterEqual(cpu_usage_ns, 50000000)
+        self.assertLess(cpu_usage_ns, 10 ** 9)
+
+    def test_not_reusable(self):
+        self.cgroup.reusable = False
+        def exit():
+            self.cgroup.exited = True
+        self.wait(exit)
+        self.assertIsNone(self.sandbox.cgroup)
+        self.assertTrue(self.cgroup.closed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+from io import BytesIO
+from time import perf_counter
+
+from jd4._compare import compare_stream
+from jd4.log import logger
+
+SIZE = 64 * 1048576
+
+def bench(name, a, b, expected):
+    start = perf_counter()
+    result = compare_stream(BytesIO(a), BytesIO(b))
+    elapsed = perf_counter() - start
+    assert result == expected
+    logger.info('%s: %.1f MB/s', name, len(a) / elapsed / 1048576)
+
+def main():
+    line = b'1234567 89012345 678901234\n'
+    output = line * (SIZE // len(line))
+    bench('identical', output, output, True)
+    bench('mismatch at end', output, output[:-2] + b'5\n', False)
+    bench('trailing whitespace', output, output.replace(b'\n', b' \r\n'), True)
+    bench('all whitespace differs', output, output.replace(b' ', b'  '), True)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from io import BytesIO
+from random import Random
 from unittest import main, TestCase
 
 from jd4._compare import compare_stream
@@ -6,6 +7,28 @@ from jd4._compare import compare_stream
 def compare(a, b):
     return compare_stream(BytesIO(a), BytesIO(b))
 
+def compare_slow(a, b):
+    ia = iter(a)
+    ib = iter(b)
+    both_spaced = True
+    while True:
+        ca = next(ia, -1)
+        cb = next(ib, -1)
+        while ca != cb:
+            if (ca == 13 or
+                (both_spaced and ca in (32, 9)) or
+                (cb in (-1, 10) and ca in (32, 10))):
+                ca = next(ia, -1)
+            elif (cb == 13 or
+                  (both_spaced and cb in (32, 9)) or
+                  (ca in (-1, 10) and cb in (32, 10))):
+                cb = next(ib, -1)
+            else:
+                return False
+        if ca == -1:
+            return True
+        both_spaced = ca in (32, 9)
+
 class CompareTest(TestCase):
     def test_small(self):
         self.assertTrue(compare(b'', b''))
@@ -97,5 +120,36 @@ class CompareTest(TestCase):
         self.assertTrue(compare(b'a' * 1048576 + b' ' + b'b' * 1048576 + b'\r\n',
                                 b'a' * 1048576 + b' ' * 1048576 + b'b' * 1048576))
 
+    def test_chunk_boundary(self):
+        for n in (255, 256, 257, 32767, 32768, 32769, 65536):
+            self.assertTrue(compare(b'a' * n + b' \n', b'a' * n))
+            self.assertTrue(compare(b'a' * n + b'  b', b'a' * n + b' b\r\n'))
+            self.assertFalse(compare(b'a' * n + b'b', b'a' * n + b'c'))
+            self.assertFalse(compare(b'a' * n, b'a' * n + b'b'))
+            self.assertFalse(compare(b'a' * n + b' b', b'a' * n + b'b'))
+
+    def test_high_bytes(self):
+        self.assertTrue(compare(b'\xff\xfe', b'\xff\xfe'))
+        self.assertFalse(compare(b'\xff1', b'\xff2'))
+        self.assertFalse(compare(b'\xff', b''))
+
+    def test_random(self):
+        random = Random(42)
+        alphabet = b'ab \t\r\n'
+        for _ in range(2000):
+            base = bytes(random.choice(alphabet)
+                         for _ in range(random.randrange(64)))
+            other = bytearray(base)
+            for _ in range(random.randrange(4)):
+                pos = random.randrange(len(other) + 1)
+                if random.randrange(2) and pos < len(other):
+                    del other[pos]
+                else:
+                    other.insert(pos, random.choice(alphabet))
+            a = base * random.randrange(1, 600)
+            b = bytes(other) * (len(a) // max(len(base), 1) or 1)
+            self.assertEqual(compare(a, b), compare_slow(a, b), (a, b))
+            self.assertEqual(compare(b, a), compare_slow(b, a), (b, a))
+
 if __name__ == '__main__':
     main()
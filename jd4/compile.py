@@ -1,19 +1,28 @@
+import json
 import shlex
 from appdirs import user_config_dir
-from asyncio import gather, get_event_loop
+from asyncio import gather, get_event_loop, shield
 from functools import partial
+from hashlib import sha256
 from ruamel import yaml
 from socket import socket, AF_UNIX, SOCK_STREAM, SOCK_NONBLOCK
 from os import mkdir, mkfifo, path
 from shutil import copytree, rmtree
 from tempfile import mkdtemp
+from time import perf_counter
+from weakref import ref
 
+from jd4.admin import admin_add_command
 from jd4.cgroup import wait_cgroup
 from jd4.log import logger
+from jd4.metrics import metrics_observe, metrics_timed
+from jd4.pkgcache import pkgcache_get, pkgcache_put, pkgcache_release
 from jd4.pool import get_sandbox, put_sandbox
 from jd4.sandbox import SANDBOX_COMPILE, SANDBOX_EXECUTE
+from jd4.trace import trace_span
 from jd4.util import parse_memory_bytes, parse_time_ns, \
-                     read_pipe, write_binary_file
+                     link_tree, read_pipe, read_text_file, write_binary_file, \
+                     write_text_file
 
 _MAX_OUTPUT = 8192
 DEFAULT_TIME = '20s'
@@ -22,6 +31,7 @@ PROCESS_LIMIT = 64
 _CONFIG_DIR = user_config_dir('jd4')
 _LANGS_FILE = path.join(_CONFIG_DIR, 'langs.yaml')
 _langs = dict()
+_builds = dict()
 _yaml = yaml.YAML()
 
 class Executable:
@@ -45,21 +55,31 @@ class Executable:
                                   cgroup_file)
 
 class Package:
-    def __init__(self, package_dir, execute_file, execute_args):
+    def __init__(self, package_dir, execute_file, execute_args, cache_key=None):
         self.package_dir = package_dir
         self.execute_file = execute_file
         self.execute_args = execute_args
+        self.cache_key = cache_key
 
     def __del__(self):
-        rmtree(self.package_dir)
+        if self.cache_key:
+            pkgcache_release(self.cache_key)
+        else:
+            rmtree(self.package_dir)
 
     async def install(self, sandbox):
         loop = get_event_loop()
-        await sandbox.reset()
-        await loop.run_in_executor(None,
-                                   copytree,
-                                   path.join(self.package_dir, 'package'),
-                                   path.join(sandbox.in_dir, 'package'))
+        start = perf_counter()
+        if sandbox.package and sandbox.package() is self:
+            await sandbox.reset(keep_package=True)
+        else:
+            await sandbox.reset()
+            await loop.run_in_executor(None,
+                                       link_tree,
+                                       path.join(self.package_dir, 'package'),
+                                       path.join(sandbox.in_dir, 'package'))
+            sandbox.package = ref(self)
+        metrics_observe('install', perf_counter() - start)
         return Executable(self.execute_file, self.execute_args)
 
 class Compiler:
@@ -77,7 +97,7 @@ class Compiler:
 
     async def prepare(self, sandbox, code):
         loop = get_event_loop()
-        await sandbox.reset()
+        await sandbox.reset(out_tmpfs=False)
         await loop.run_in_executor(None,
                                    write_binary_file,
                                    path.join(sandbox.in_dir, self.code_file),
@@ -118,7 +138,8 @@ async def _compiler_build(compiler,
                           process_limit,
                           code):
     loop = get_event_loop()
-    sandbox, = await get_sandbox(1)
+    with trace_span('wait'):
+        sandbox, = await get_sandbox(1)
     try:
         await compiler.prepare(sandbox, code)
         output_file = path.join(sandbox.in_dir, 'output')
@@ -136,14 +157,68 @@ async def _compiler_build(compiler,
                                              time_limit_ns,
                                              time_limit_ns,
                                              memory_limit_bytes,
-                                             process_limit))
-            package, status = await build_task
+                                             process_limit,
+                                             sandbox))
+            with trace_span('compile'):
+                package, status = await metrics_timed('compile', build_task)
             output, (time_usage_ns, memory_usage_bytes) = await others_task
         return package, output.decode(encoding='utf-8', errors='replace'), \
                time_usage_ns, memory_usage_bytes
     finally:
         put_sandbox(sandbox)
 
+async def _cached_compiler_build(lang_name,
+                                 lang_hash,
+                                 compiler,
+                                 time_limit_ns,
+                                 memory_limit_bytes,
+                                 process_limit,
+                                 code):
+    loop = get_event_loop()
+    key = '{}-{}-{}'.format(lang_name, lang_hash, sha256(code).hexdigest())
+    build_task = _builds.get(key)
+    if build_task:
+        return await shield(build_task)
+
+    async def do_build():
+        cache_path = await pkgcache_get(key)
+        if cache_path:
+            message = await loop.run_in_executor(
+                None, read_text_file, path.join(cache_path, 'message'))
+            if not path.isdir(path.join(cache_path, 'package')):
+                pkgcache_release(key)
+                return None, message, 0, 0
+            return Package(cache_path, compiler.execute_file,
+                           compiler.execute_args, key), message, 0, 0
+        package, message, time_usage_ns, memory_usage_bytes = \
+            await _compiler_build(compiler,
+                                  time_limit_ns,
+                                  memory_limit_bytes,
+                                  process_limit,
+                                  code)
+        if not package:
+            # Compile errors are cached as a message without a package, unless
+            # the compiler hit a limit, which may not happen again.
+            if time_usage_ns < time_limit_ns and memory_usage_bytes < memory_limit_bytes:
+                failure_dir = mkdtemp(prefix='jd4.package.')
+                await loop.run_in_executor(None, write_text_file,
+                                           path.join(failure_dir, 'message'), message)
+                await pkgcache_put(key, failure_dir)
+                pkgcache_release(key)
+            return package, message, time_usage_ns, memory_usage_bytes
+        await loop.run_in_executor(None, write_text_file,
+                                   path.join(package.package_dir, 'message'),
+                                   message)
+        cache_path = await pkgcache_put(key, package.package_dir)
+        package.cache_key = key
+        package.package_dir = cache_path
+        return package, message, time_usage_ns, memory_usage_bytes
+
+    build_task = loop.create_task(do_build())
+    _builds[key] = build_task
+    build_task.add_done_callback(lambda _: _builds.pop(key))
+    return await shield(build_task)
+
 async def _interpreter_build(interpreter, code):
     return interpreter.build(code), '', 0, 0
 
@@ -153,13 +228,10 @@ async def build(lang, code):
         raise SystemError('Unsupported language: {}'.format(lang))
     return await build_fn(code)
 
-def _init():
-    try:
-        with open(_LANGS_FILE) as file:
-            langs_config = _yaml.load(file)
-    except FileNotFoundError:
-        logger.error('Language file %s not found.', _LANGS_FILE)
-        exit(1)
+def _load_langs():
+    with open(_LANGS_FILE) as file:
+        langs_config = _yaml.load(file)
+    langs = dict()
     for lang_name, lang_config in langs_config.items():
         if lang_config['type'] == 'compiler':
             compiler = Compiler(lang_config['compiler_file'],
@@ -167,8 +239,12 @@ def _init():
                                 lang_config['code_file'],
                                 lang_config['execute_file'],
                                 shlex.split(lang_config['execute_args']))
-            _langs[lang_name] = partial(
-                _compiler_build,
+            lang_hash = sha256(json.dumps(lang_config, sort_keys=True)
+                               .encode()).hexdigest()[:16]
+            langs[lang_name] = partial(
+                _cached_compiler_build,
+                lang_name,
+                lang_hash,
                 compiler,
                 parse_time_ns(lang_config.get('time', DEFAULT_TIME)),
                 parse_memory_bytes(lang_config.get('memory', DEFAULT_MEMORY)),
@@ -177,8 +253,24 @@ def _init():
             interpreter = Interpreter(lang_config['code_file'],
                                       lang_config['execute_file'],
                                       shlex.split(lang_config['execute_args']))
-            _langs[lang_name] = partial(_interpreter_build, interpreter)
+            langs[lang_name] = partial(_interpreter_build, interpreter)
         else:
             logger.error('Unknown type %s', lang_config['type'])
+    return langs
+
+async def reload_langs():
+    langs = await get_event_loop().run_in_executor(None, _load_langs)
+    _langs.clear()
+    _langs.update(langs)
+    logger.info('Reloaded %d languages', len(langs))
+    return sorted(langs)
+
+def _init():
+    try:
+        _langs.update(_load_langs())
+    except FileNotFoundError:
+        logger.error('Language file %s not found.', _LANGS_FILE)
+        exit(1)
+    admin_add_command('reload_langs', reload_langs)
 
 _init()
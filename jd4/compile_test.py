@@ -0,0 +1,101 @@
+from asyncio import get_event_loop
+from os import makedirs, path, stat
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4 import compile, pkgcache
+from jd4.compile import Compiler, Package
+from jd4.util import write_binary_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class FakeSandbox:
+    def __init__(self, in_dir):
+        self.in_dir = in_dir
+        self.package = None
+        self.resets = list()
+
+    async def reset(self, keep_package=False):
+        self.resets.append(keep_package)
+        if not keep_package:
+            self.package = None
+            rmtree(path.join(self.in_dir, 'package'), ignore_errors=True)
+
+class InstallTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.sandbox = FakeSandbox(path.join(self.tmp_dir.name, 'in'))
+        makedirs(self.sandbox.in_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_package(self, name):
+        package_dir = path.join(self.tmp_dir.name, name)
+        makedirs(path.join(package_dir, 'package', 'lib'))
+        write_binary_file(path.join(package_dir, 'package', 'foo'), name.encode())
+        write_binary_file(path.join(package_dir, 'package', 'lib', 'bar'), b'bar')
+        return Package(package_dir, 'foo', ['foo'])
+
+    def installed(self, *parts):
+        return path.join(self.sandbox.in_dir, 'package', *parts)
+
+    def test_linked(self):
+        package = self.make_package('a')
+        executable = run(package.install(self.sandbox))
+        self.assertEqual(executable.execute_file, 'foo')
+        self.assertEqual(self.sandbox.resets, [False])
+        for parts in ('foo',), ('lib', 'bar'):
+            self.assertEqual(stat(self.installed(*parts)).st_ino,
+                             stat(path.join(package.package_dir, 'package', *parts)).st_ino)
+
+    def test_reinstall(self):
+        first, second = self.make_package('a'), self.make_package('b')
+        run(first.install(self.sandbox))
+        run(first.install(self.sandbox))
+        self.assertEqual(self.sandbox.resets, [False, True])
+        run(second.install(self.sandbox))
+        self.assertEqual(self.sandbox.resets, [False, True, False])
+        with open(self.installed('foo'), 'rb') as file:
+            self.assertEqual(file.read(), b'b')
+
+class CachedBuildTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.old_state = pkgcache._PKGCACHE_DIR, pkgcache._index, compile._compiler_build
+        pkgcache._PKGCACHE_DIR = path.join(self.tmp_dir.name, 'cache')
+        pkgcache._index = None
+        compile._compiler_build = self.compiler_build
+        self.compiler = Compiler('/usr/bin/cc', ['cc'], 'foo.c', 'foo', ['foo'])
+        self.builds = list()
+        self.time_usage_ns = 1000
+
+    def tearDown(self):
+        pkgcache._PKGCACHE_DIR, pkgcache._index, compile._compiler_build = self.old_state
+        self.tmp_dir.cleanup()
+
+    async def compiler_build(self, compiler, time_limit_ns, memory_limit_bytes,
+                             process_limit, code):
+        self.builds.append(code)
+        return None, 'error', self.time_usage_ns, 1024
+
+    def build(self, code):
+        return run(compile._cached_compiler_build(
+            'c', 'hash', self.compiler, 1000000000, 268435456, 64, code))
+
+    def test_failure_cached(self):
+        self.assertEqual(self.build(b'x'), (None, 'error', 1000, 1024))
+        self.assertEqual(self.build(b'x'), (None, 'error', 0, 0))
+        self.assertEqual(self.builds, [b'x'])
+        self.assertFalse(pkgcache._pins)
+
+    def test_limit_not_cached(self):
+        self.time_usage_ns = 1000000000
+        self.build(b'x')
+        self.build(b'x')
+        self.assertEqual(self.builds, [b'x', b'x'])
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,45 @@
 from aiohttp import ClientError
-from asyncio import create_task, gather, get_event_loop, sleep, shield, wait, FIRST_COMPLETED
+from asyncio import create_task, gather, get_event_loop, sleep, shield, wait, \
+                    Event, FIRST_COMPLETED
 from io import BytesIO
 
-from jd4.api import VJ4Session
+from jd4.admin import admin_add_command, start_admin_server
+from jd4.api import download_stats, VJ4Session
 from jd4.case import read_cases
-from jd4.cache import cache_open, cache_invalidate
+from jd4.cache import cache_checkers, cache_failures, cache_invalidate, cache_stats
 from jd4.cgroup import try_init_cgroup
 from jd4.compile import build
 from jd4.config import config, save_config
 from jd4.log import logger
-from jd4.pool import init as init_pool
-from jd4.status import STATUS_ACCEPTED, STATUS_COMPILE_ERROR, \
+from jd4.metrics import metrics_add_gauge, metrics_timed, start_metrics_server
+from jd4.pool import init as init_pool, pool_stats, set_priority
+from jd4.prefetch import prefetch_invalidated, prefetch_seen, start_prefetch
+from jd4.progress import ProgressBatcher
+from jd4.sandbox import reset_stats
+from jd4.status import STATUS_ACCEPTED, STATUS_CANCELED, STATUS_COMPILE_ERROR, \
     STATUS_SYSTEM_ERROR, STATUS_JUDGING, STATUS_COMPILING
+from jd4.store import store_cases
+from jd4.trace import trace_finish, trace_span, trace_start, trace_thread, trace_timed
 
 RETRY_DELAY_SEC = 30
+_records = dict()
 
 class CompileError(Exception):
     pass
 
+async def _fetch_data(awaitable):
+    # A failed download only fails the record, the websocket is still fine.
+    try:
+        return await awaitable
+    except ClientError as e:
+        raise SystemError('Problem data fetch failed: {!r}'.format(e)) from e
+
 class JudgeHandler:
     def __init__(self, session, request, ws):
         self.session = session
         self.request = request
         self.ws = ws
+        self.progress = ProgressBatcher(self.send_next)
 
     async def handle(self):
         event = self.request.pop('event', None)
@@ -43,13 +60,28 @@ class JudgeHandler:
         self.rid = self.request.pop('rid')
         self.lang = self.request.pop('lang')
         self.code = self.request.pop('code')
-        try:
-            if self.type == 0:
-                await self.do_submission()
-            elif self.type == 1:
-                await self.do_pretest()
+        self.fail_fast = self.request.pop('fail_fast', config.get('fail_fast', False))
+        priority = self.request.pop('priority', None)
+        if not priority:
+            if self.type == 1:
+                priority = 'pretest'
+            elif self.domain_id in config.get('contest_domains', ()):
+                priority = 'contest'
             else:
-                raise Exception('Unsupported type: {}'.format(self.type))
+                priority = config.get('priority', 'normal')
+        self.failures = None
+        _records[self.tag] = self
+        trace_start('record {}'.format(self.rid))
+        try:
+            set_priority(priority)
+            with trace_span('handler', rid=self.rid, domain_id=self.domain_id,
+                            pid=str(self.pid), lang=self.lang, priority=priority):
+                if self.type == 0:
+                    await self.do_submission()
+                elif self.type == 1:
+                    await self.do_pretest()
+                else:
+                    raise Exception('Unsupported type: {}'.format(self.type))
         except CompileError:
             await self.end(status=STATUS_COMPILE_ERROR, score=0, time_ms=0, memory_kb=0)
         except ClientError:
@@ -58,56 +90,124 @@ class JudgeHandler:
             logger.exception(e)
             await self.next(judge_text=repr(e))
             await self.end(status=STATUS_SYSTEM_ERROR, score=0, time_ms=0, memory_kb=0)
+        finally:
+            del _records[self.tag]
+            await trace_finish(self.rid)
 
     async def update_problem_data(self):
         domain_id = self.request.pop('domain_id')
         pid = str(self.request.pop('pid'))
         await cache_invalidate(domain_id, pid)
         logger.debug('Invalidated %s/%s', domain_id, pid)
+        prefetch_invalidated(domain_id, pid)
         await update_problem_data(self.session)
 
     async def do_submission(self):
         loop = get_event_loop()
         logger.info('Submission: %s, %s, %s', self.domain_id, self.pid, self.rid)
-        cases_file_task = loop.create_task(cache_open(self.session, self.domain_id, self.pid))
+        prefetch_seen(self.domain_id, str(self.pid))
+        cases_task = loop.create_task(_fetch_data(trace_timed('data', store_cases(
+            self.session, self.domain_id, self.pid,
+            cache_checkers(self.domain_id, str(self.pid))), 'data')))
+        self.failures = cache_failures(self.domain_id, str(self.pid))
         package = await self.build()
-        with await cases_file_task as cases_file:
-            await self.judge(cases_file, package)
+        await self.judge(await cases_task, package)
 
     async def do_pretest(self):
         loop = get_event_loop()
         logger.info('Pretest: %s, %s, %s', self.domain_id, self.pid, self.rid)
-        cases_data_task = loop.create_task(self.session.record_pretest_data(self.rid))
+        cases_data_task = loop.create_task(_fetch_data(trace_timed(
+            'data', self.session.record_pretest_data(self.rid), 'data')))
         package = await self.build()
         with BytesIO(await cases_data_task) as cases_file:
-            await self.judge(cases_file, package)
+            await self.judge(read_cases(cases_file), package)
 
     async def build(self):
         await self.next(status=STATUS_COMPILING)
-        package, message, _, _ = await shield(build(self.lang, self.code.encode()))
+        with trace_span('build'):
+            package, message, _, _ = await shield(build(self.lang, self.code.encode()))
         await self.next(compiler_text=message)
         if not package:
             logger.debug('Compile error: %s', message)
             raise CompileError(message)
         return package
 
-    async def judge(self, cases_file, package):
+    async def judge(self, cases, package):
         loop = get_event_loop()
         await self.next(status=STATUS_JUDGING, progress=0)
-        cases = list(read_cases(cases_file))
+        cases = list(cases)
         total_status = STATUS_ACCEPTED
         total_score = 0
         total_time_usage_ns = 0
         total_memory_usage_bytes = 0
-        judge_tasks = list()
+        subtask_scores = dict()
+        aborts = dict()
+        dependents = dict()
         for case in cases:
-            judge_tasks.append(loop.create_task(case.judge(package)))
+            if case.subtask and case.subtask.id not in aborts:
+                aborts[case.subtask.id] = loop.create_future()
+                for depend in case.subtask.depends:
+                    dependents.setdefault(depend, list()).append(case.subtask.id)
+        if self.fail_fast:
+            aborts[None] = loop.create_future()
+
+        def abort(key):
+            keys = [key]
+            while keys:
+                key = keys.pop()
+                if key in aborts and not aborts[key].done():
+                    aborts[key].set_result(None)
+                    keys.extend(dependents.get(key, ()))
+
+        def on_done(key, judge_task):
+            if judge_task.cancelled():
+                return
+            if judge_task.exception():
+                status, score = STATUS_SYSTEM_ERROR, 0
+            elif judge_task.result():
+                status, score = judge_task.result()[:2]
+            else:
+                return
+            if self.fail_fast and status != STATUS_ACCEPTED:
+                for key in list(aborts):
+                    abort(key)
+            elif key is not None and not score:
+                abort(key)
+
+        order = range(len(cases))
+        if self.fail_fast and self.failures and config.get('failed_cases_first', False):
+            order = sorted(order, key=lambda index: -self.failures.get(index, 0))
+        judge_tasks = [None] * len(cases)
+        for index in order:
+            key = cases[index].subtask.id if cases[index].subtask else None
+            judge_task = loop.create_task(trace_thread(
+                'case {}'.format(index + 1), cases[index].judge(package, aborts.get(key))))
+            judge_task.add_done_callback(lambda task, key=key: on_done(key, task))
+            judge_tasks[index] = judge_task
         for index, judge_task in enumerate(judge_tasks):
-            status, score, time_usage_ns, memory_usage_bytes, stderr = await shield(judge_task)
+            subtask = cases[index].subtask
+            result = await shield(judge_task)
+            if not result:
+                if subtask:
+                    subtask_scores[subtask.id] = 0
+                await self.next(status=STATUS_JUDGING,
+                                case={'status': STATUS_CANCELED,
+                                      'score': 0,
+                                      'time_ms': 0,
+                                      'memory_kb': 0,
+                                      'judge_text': 'Skipped'},
+                                progress=(index + 1) * 100 // len(cases))
+                continue
+            status, score, time_usage_ns, memory_usage_bytes, stderr, contended = result
+            if self.failures is not None and status != STATUS_ACCEPTED:
+                self.failures[index] = self.failures.get(index, 0) + 1
             if self.type == 1:
                 judge_text = stderr.decode(encoding='utf-8', errors='replace')
             else:
                 judge_text = ''
+            if contended:
+                logger.warning('Record %s case %d judged under contention', self.rid, index)
+                judge_text = '\n'.join(filter(None, (judge_text, 'Judged under contention.')))
             await self.next(status=STATUS_JUDGING,
                             case={'status': status,
                                   'score': score,
@@ -116,32 +216,60 @@ class JudgeHandler:
                                   'judge_text': judge_text},
                             progress=(index + 1) * 100 // len(cases))
             total_status = max(total_status, status)
-            total_score += score
+            if subtask:
+                subtask_scores[subtask.id] = min(subtask_scores.get(subtask.id, score), score)
+            else:
+                total_score += score
             total_time_usage_ns += time_usage_ns
             total_memory_usage_bytes = max(total_memory_usage_bytes, memory_usage_bytes)
+        # Cases of a subtask may finish before a subtask it depends on fails,
+        # so dependencies are applied again once every case is done.
+        depends = {case.subtask.id: case.subtask.depends for case in cases if case.subtask}
+
+        def failed(id):
+            keys = list(depends.get(id, ()))
+            seen = set()
+            while keys:
+                key = keys.pop()
+                if key in seen:
+                    continue
+                seen.add(key)
+                if not subtask_scores.get(key, 1):
+                    return True
+                keys.extend(depends.get(key, ()))
+            return False
+
+        total_score += sum(score for id, score in subtask_scores.items() if not failed(id))
         await self.end(status=total_status,
                        score=total_score,
                        time_ms=total_time_usage_ns // 1000000,
                        memory_kb=total_memory_usage_bytes // 1024)
 
     async def next(self, **kwargs):
-        await self.ws.send_json({'key': 'next', 'tag': self.tag, **kwargs})
+        await self.progress.next(**kwargs)
+
+    async def send_next(self, kwargs):
+        await metrics_timed('send', self.ws.send_json({'key': 'next', 'tag': self.tag, **kwargs}))
 
     async def end(self, **kwargs):
-        await self.ws.send_json({'key': 'end', 'tag': self.tag, **kwargs})
+        await self.progress.flush()
+        await metrics_timed('send', self.ws.send_json({'key': 'end', 'tag': self.tag, **kwargs}))
 
 async def update_problem_data(session):
     logger.info('Update problem data')
-    result = await session.judge_datalist(config.get('last_update_at', 0))
+    last_update_at = config.get('last_update_at', 0)
+    result = await session.judge_datalist(last_update_at)
     for pid in result['pids']:
         await cache_invalidate(pid['domain_id'], str(pid['pid']))
         logger.debug('Invalidated %s/%s', pid['domain_id'], str(pid['pid']))
+        # The first list names every problem, only prefetch the judged ones.
+        prefetch_invalidated(pid['domain_id'], str(pid['pid']), force=bool(last_update_at))
     config['last_update_at'] = result['time']
     await save_config()
 
-async def do_judge(session):
+async def do_judge(session, drain=None):
     await update_problem_data(session)
-    await session.judge_consume(JudgeHandler)
+    await session.judge_consume(JudgeHandler, config.get('concurrency', 1), drain)
 
 async def do_noop(session):
     while True:
@@ -149,12 +277,69 @@ async def do_noop(session):
         logger.info('Updating session')
         await session.judge_noop()
 
+def add_metrics(session):
+    def queued():
+        queue = session.judge_queue
+        return queue.qsize() if queue else 0
+
+    def hit_ratio():
+        stats = cache_stats()
+        total = stats['hits'] + stats['misses']
+        return stats['hits'] / total if total else 0
+
+    metrics_add_gauge('jd4_judge_queue_depth', 'Judge requests waiting for a worker.', queued)
+    metrics_add_gauge('jd4_records', 'Records being judged.', lambda: len(_records))
+    for key, help in (('sandboxes', 'Sandboxes in the pool.'),
+                      ('idle', 'Idle sandboxes.'),
+                      ('waiters', 'Requests waiting for sandboxes.'),
+                      ('utilization', 'Busy share of sandbox time since start.')):
+        metrics_add_gauge('jd4_pool_' + key, help, lambda key=key: pool_stats()[key])
+    for key in 'hits', 'misses', 'evictions', 'revalidations':
+        metrics_add_gauge('jd4_data_cache_{}_total'.format(key),
+                          'Problem data cache {}.'.format(key),
+                          lambda key=key: cache_stats()[key], 'counter')
+    metrics_add_gauge('jd4_data_cache_hit_ratio', 'Problem data cache hit ratio.', hit_ratio)
+    metrics_add_gauge('jd4_download_bytes_total', 'Problem data bytes downloaded.',
+                      lambda: download_stats()['bytes'], 'counter')
+
 async def daemon():
+    drain = Event()
+    resume = Event()
+
+    async def do_drain():
+        resume.clear()
+        drain.set()
+        return len(_records)
+
+    async def do_resume():
+        drain.clear()
+        resume.set()
+
+    async def do_status():
+        return {'draining': drain.is_set(),
+                'queued': session.judge_queue.qsize() if session.judge_queue else 0,
+                'records': [{'tag': handler.tag, 'type': handler.type,
+                             'domain_id': handler.domain_id, 'pid': handler.pid,
+                             'rid': handler.rid} for handler in _records.values()],
+                'pool': pool_stats(),
+                'cache': cache_stats(),
+                'reset': reset_stats()}
+
+    admin_add_command('drain', do_drain)
+    admin_add_command('resume', do_resume)
+    admin_add_command('status', do_status)
+    await start_admin_server()
     async with VJ4Session(config['server_url']) as session:
+        start_prefetch(session)
+        add_metrics(session)
+        await start_metrics_server()
         while True:
+            if drain.is_set():
+                logger.info('Drained, waiting for resume')
+                await resume.wait()
             try:
                 await session.login_if_needed(config['uname'], config['password'])
-                done, pending = await wait([create_task(do_judge(session)),
+                done, pending = await wait([create_task(do_judge(session, drain)),
                                             create_task(do_noop(session))],
                                            return_when=FIRST_COMPLETED)
                 for task in pending:
@@ -162,6 +347,8 @@ async def daemon():
                 await gather(*done)
             except Exception as e:
                 logger.exception(e)
+            if drain.is_set():
+                continue
             logger.info('Retrying after %d seconds', RETRY_DELAY_SEC)
             await sleep(RETRY_DELAY_SEC)
 
@@ -0,0 +1,116 @@
+from asyncio import get_event_loop, sleep
+from unittest import main, TestCase
+
+from jd4.case import Subtask
+from jd4.config import config
+from jd4.daemon import JudgeHandler
+from jd4.status import STATUS_ACCEPTED, STATUS_CANCELED, STATUS_SYSTEM_ERROR, \
+    STATUS_WRONG_ANSWER
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class FakeWebSocket:
+    def __init__(self):
+        self.messages = list()
+
+    async def send_json(self, message):
+        self.messages.append(message)
+
+class FakeCase:
+    started = list()
+
+    def __init__(self, score, delay_sec=0, subtask=None, contended=False):
+        self.score = score
+        self.delay_sec = delay_sec
+        self.subtask = subtask
+        self.contended = contended
+
+    async def judge(self, package, abort=None):
+        self.started.append(self)
+        await sleep(self.delay_sec)
+        if abort and abort.done():
+            return None
+        status = STATUS_ACCEPTED if self.score else STATUS_WRONG_ANSWER
+        return status, self.score, 1000000, 1024, b'', self.contended
+
+class JudgeTest(TestCase):
+    def setUp(self):
+        FakeCase.started.clear()
+
+    def tearDown(self):
+        config.pop('failed_cases_first', None)
+
+    def judge(self, cases, fail_fast=False, failures=None):
+        ws = FakeWebSocket()
+        handler = JudgeHandler(None, dict(), ws)
+        handler.tag = 'tag'
+        handler.type = 0
+        handler.rid = 'rid'
+        handler.fail_fast = fail_fast
+        handler.failures = dict() if failures is None else failures
+        run(handler.judge(cases, None))
+        return [message['case'] for message in ws.messages if 'case' in message], \
+               ws.messages[-1]
+
+    def test_subtask_min(self):
+        subtask = Subtask(1, [])
+        _, end = self.judge([FakeCase(30, subtask=subtask), FakeCase(20, subtask=subtask),
+                             FakeCase(10)])
+        self.assertEqual(end['key'], 'end')
+        self.assertEqual(end['score'], 30)
+
+    def test_depends_skip(self):
+        first, second = Subtask(1, []), Subtask(2, [1])
+        cases, end = self.judge([FakeCase(0, subtask=first),
+                                 FakeCase(50, 0.05, subtask=second)])
+        self.assertEqual(cases[1]['status'], STATUS_CANCELED)
+        self.assertEqual(cases[1]['judge_text'], 'Skipped')
+        self.assertEqual(end['status'], STATUS_WRONG_ANSWER)
+        self.assertEqual(end['score'], 0)
+
+    def test_depends_finished_first(self):
+        first, second, third = Subtask(1, []), Subtask(2, [1]), Subtask(3, [2])
+        cases, end = self.judge([FakeCase(0, 0.05, subtask=first),
+                                 FakeCase(50, subtask=second),
+                                 FakeCase(20, subtask=third),
+                                 FakeCase(30, subtask=Subtask(4, []))])
+        self.assertEqual([case['score'] for case in cases], [0, 50, 20, 30])
+        self.assertEqual(end['status'], STATUS_WRONG_ANSWER)
+        self.assertEqual(end['score'], 30)
+
+    def test_fail_fast(self):
+        failures = dict()
+        cases, end = self.judge([FakeCase(10), FakeCase(0, 0.01), FakeCase(10, 0.05),
+                                 FakeCase(10, 0.05)], True, failures)
+        self.assertEqual([case['status'] for case in cases],
+                         [STATUS_ACCEPTED, STATUS_WRONG_ANSWER, STATUS_CANCELED, STATUS_CANCELED])
+        self.assertEqual(end['status'], STATUS_WRONG_ANSWER)
+        self.assertEqual(end['score'], 10)
+        self.assertEqual(failures, {1: 1})
+
+    def test_failed_cases_first(self):
+        config['failed_cases_first'] = True
+        judge_cases = [FakeCase(10, 0.05), FakeCase(10, 0.05), FakeCase(0)]
+        cases, end = self.judge(judge_cases, True, {2: 3, 1: 1})
+        self.assertIs(FakeCase.started[0], judge_cases[2])
+        self.assertEqual([case['status'] for case in cases],
+                         [STATUS_CANCELED, STATUS_CANCELED, STATUS_WRONG_ANSWER])
+        self.assertEqual(end['score'], 0)
+
+    def test_contended(self):
+        cases, _ = self.judge([FakeCase(10, contended=True), FakeCase(10)])
+        self.assertEqual([case['judge_text'] for case in cases],
+                         ['Judged under contention.', ''])
+
+class RecordTest(TestCase):
+    def test_bad_priority(self):
+        ws = FakeWebSocket()
+        request = {'tag': 'tag', 'type': 2, 'domain_id': 'system', 'pid': '1', 'rid': 'rid',
+                   'lang': 'c', 'code': '', 'priority': 'urgent'}
+        run(JudgeHandler(None, request, ws).handle())
+        self.assertEqual(ws.messages[-1]['key'], 'end')
+        self.assertEqual(ws.messages[-1]['status'], STATUS_SYSTEM_ERROR)
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,7 @@ class LanguageTest(TestCase):
         if message:
             logger.warning('Compiler output is not empty: %s', message)
         for case in self.cases:
-            status, score, time_usage_ns, memory_usage_bytes, stderr = \
+            status, score, time_usage_ns, memory_usage_bytes, stderr, _ = \
                 run(case.judge(package))
             self.assertEqual(status, STATUS_ACCEPTED)
             self.assertEqual(score, 10)
@@ -136,7 +136,7 @@ class StatusTest(TestCase):
         self.assertIsNotNone(package, 'Compile failed: ' + message)
         if message:
             logger.warning('Compiler output is not empty: %s', message)
-        status, score, time_usage_ns, memory_usage_bytes, stderr = \
+        status, score, time_usage_ns, memory_usage_bytes, stderr, _ = \
             run(self.case.judge(package))
         self.assertEqual(status, expected_status)
         self.assertEqual(score, expected_score)
@@ -179,7 +179,7 @@ class CustomJudgeTest(TestCase):
         total_status = STATUS_ACCEPTED
         total_score = 0
         for case in self.cases:
-            status, score, time_usage_ns, memory_usage_bytes, stderr = \
+            status, score, time_usage_ns, memory_usage_bytes, stderr, _ = \
                 run(case.judge(package))
             total_status = max(total_status, status)
             total_score += score
@@ -0,0 +1,92 @@
+from aiohttp import web
+from asyncio import get_event_loop, sleep
+from time import perf_counter
+
+from jd4.config import config
+from jd4.log import logger
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_LAG_INTERVAL_SEC = 1
+_histograms = {'jd4_stage_seconds': ('Latency of judge pipeline stages.', dict()),
+               'jd4_event_loop_lag_seconds': ('Delay of event loop callbacks.', dict())}
+_gauges = dict()
+
+def metrics_observe(stage, seconds, name='jd4_stage_seconds'):
+    series = _histograms[name][1]
+    key = 'stage="{}"'.format(stage) if stage else ''
+    histogram = series.get(key)
+    if not histogram:
+        histogram = series[key] = [0] * (len(BUCKETS) + 2)
+    for index, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            histogram[index] += 1
+    histogram[-2] += seconds
+    histogram[-1] += 1
+
+async def metrics_timed(stage, awaitable):
+    """Awaits and observes the latency of the awaitable under the stage."""
+    start = perf_counter()
+    try:
+        return await awaitable
+    finally:
+        metrics_observe(stage, perf_counter() - start)
+
+def metrics_add_gauge(name, help, callback, type='gauge'):
+    """Registers a callback returning the current value of a metric."""
+    _gauges[name] = help, type, callback
+
+def _labels(key, extra=''):
+    labels = ','.join(filter(None, (key, extra)))
+    return '{' + labels + '}' if labels else ''
+
+def render():
+    lines = list()
+    for name, (help, series) in _histograms.items():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} histogram'.format(name))
+        for key, histogram in sorted(series.items()):
+            for bound, count in zip(BUCKETS, histogram):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(key, 'le="{}"'.format(bound)), count))
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(key, 'le="+Inf"'), histogram[-1]))
+            lines.append('{}_sum{} {}'.format(name, _labels(key), histogram[-2]))
+            lines.append('{}_count{} {}'.format(name, _labels(key), histogram[-1]))
+    for name, (help, type, callback) in _gauges.items():
+        try:
+            value = callback()
+        except Exception as e:
+            logger.warning('Metric %s failed: %r', name, e)
+            continue
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, type))
+        lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+async def _measure_lag(interval_sec):
+    loop = get_event_loop()
+    while True:
+        start = loop.time()
+        await sleep(interval_sec)
+        metrics_observe(None, max(loop.time() - start - interval_sec, 0),
+                        'jd4_event_loop_lag_seconds')
+
+async def _handle(request):
+    return web.Response(body=render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_metrics_server():
+    port = config.get('metrics_port')
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', _handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    host = config.get('metrics_host', DEFAULT_HOST)
+    await web.TCPSite(runner, host, port).start()
+    get_event_loop().create_task(_measure_lag(
+        config.get('metrics_lag_interval_sec', DEFAULT_LAG_INTERVAL_SEC)))
+    logger.info('Metrics: http://%s:%d/metrics', host, port)
+    return runner
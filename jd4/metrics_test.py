@@ -0,0 +1,64 @@
+from aiohttp import ClientSession
+from asyncio import get_event_loop, sleep
+from socket import socket
+from unittest import main, TestCase
+
+from jd4 import metrics
+from jd4.config import config
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.old_state = metrics._histograms, metrics._gauges
+        metrics._histograms = {name: (help, dict())
+                               for name, (help, _) in metrics._histograms.items()}
+        metrics._gauges = dict()
+
+    def tearDown(self):
+        metrics._histograms, metrics._gauges = self.old_state
+        config.pop('metrics_port', None)
+
+    def test_histogram(self):
+        metrics.metrics_observe('compile', 0.2)
+        metrics.metrics_observe('compile', 3)
+        text = metrics.render()
+        self.assertIn('jd4_stage_seconds_bucket{stage="compile",le="0.1"} 0\n', text)
+        self.assertIn('jd4_stage_seconds_bucket{stage="compile",le="0.25"} 1\n', text)
+        self.assertIn('jd4_stage_seconds_bucket{stage="compile",le="5"} 2\n', text)
+        self.assertIn('jd4_stage_seconds_bucket{stage="compile",le="+Inf"} 2\n', text)
+        self.assertIn('jd4_stage_seconds_sum{stage="compile"} 3.2\n', text)
+        self.assertIn('jd4_stage_seconds_count{stage="compile"} 2\n', text)
+
+    def test_timed(self):
+        self.assertEqual(run(metrics.metrics_timed('execute', sleep(0.01, 42))), 42)
+        self.assertIn('jd4_stage_seconds_count{stage="execute"} 1\n', metrics.render())
+
+    def test_gauge(self):
+        metrics.metrics_add_gauge('jd4_foo', 'Foo.', lambda: 3)
+        metrics.metrics_add_gauge('jd4_bar', 'Bar.', lambda: 1 / 0)
+        text = metrics.render()
+        self.assertIn('# TYPE jd4_foo gauge\njd4_foo 3\n', text)
+        self.assertNotIn('jd4_bar', text)
+
+    def test_server(self):
+        with socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            config['metrics_port'] = sock.getsockname()[1]
+        metrics.metrics_add_gauge('jd4_foo', 'Foo.', lambda: 3)
+
+        async def scrape():
+            runner = await metrics.start_metrics_server()
+            try:
+                async with ClientSession() as session:
+                    async with session.get('http://127.0.0.1:{}/metrics'.format(
+                            config['metrics_port'])) as response:
+                        return await response.text()
+            finally:
+                await runner.cleanup()
+
+        self.assertIn('jd4_foo 3\n', run(scrape()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from appdirs import user_cache_dir
+from asyncio import get_event_loop
+from collections import OrderedDict
+from os import listdir, lstat, makedirs, path, rename, rmdir, utime, walk
+from shutil import move, rmtree
+from tempfile import mkdtemp
+
+from jd4.config import config
+from jd4.log import logger
+from jd4.util import parse_memory_bytes
+
+_PKGCACHE_DIR = path.join(user_cache_dir('jd4'), '.packages')
+DEFAULT_PKGCACHE_SIZE = '1g'
+_index = None
+_pins = dict()
+
+def _dir_size(dirname):
+    size = 0
+    for dirpath, _, filenames in walk(dirname):
+        for filename in filenames:
+            size += lstat(path.join(dirpath, filename)).st_size
+    return size
+
+def _load_index():
+    makedirs(_PKGCACHE_DIR, exist_ok=True)
+    entries = list()
+    for name in listdir(_PKGCACHE_DIR):
+        full_path = path.join(_PKGCACHE_DIR, name)
+        if name.startswith('tmp_'):
+            rmtree(full_path, ignore_errors=True)
+            continue
+        entries.append((lstat(full_path).st_mtime, name, _dir_size(full_path)))
+    entries.sort()
+    return OrderedDict((name, size) for _, name, size in entries)
+
+async def _get_index():
+    global _index
+    if _index is None:
+        index = await get_event_loop().run_in_executor(None, _load_index)
+        if _index is None:
+            _index = index
+            logger.info('Package cache: %d entries, %d bytes',
+                        len(_index), sum(_index.values()))
+    return _index
+
+def _limit_bytes():
+    return parse_memory_bytes(str(config.get('package_cache_size',
+                                             DEFAULT_PKGCACHE_SIZE)))
+
+def _pin(key):
+    _pins[key] = _pins.get(key, 0) + 1
+
+def pkgcache_release(key):
+    count = _pins.pop(key) - 1
+    if count:
+        _pins[key] = count
+
+async def _evict(index):
+    loop = get_event_loop()
+    limit_bytes = _limit_bytes()
+    total_bytes = sum(index.values())
+    for key in list(index):
+        if total_bytes <= limit_bytes:
+            break
+        if key in _pins:
+            continue
+        total_bytes -= index.pop(key)
+        dead_path = mkdtemp(prefix='tmp_', dir=_PKGCACHE_DIR)
+        rename(path.join(_PKGCACHE_DIR, key), path.join(dead_path, key))
+        await loop.run_in_executor(None, rmtree, dead_path)
+        logger.debug('Package cache evicted %s', key)
+
+async def pkgcache_get(key):
+    index = await _get_index()
+    if key not in index:
+        return None
+    index.move_to_end(key)
+    _pin(key)
+    cache_path = path.join(_PKGCACHE_DIR, key)
+    await get_event_loop().run_in_executor(None, utime, cache_path)
+    return cache_path
+
+async def pkgcache_put(key, src_dir):
+    loop = get_event_loop()
+    index = await _get_index()
+    tmp_dir = mkdtemp(prefix='tmp_', dir=_PKGCACHE_DIR)
+    tmp_path = path.join(tmp_dir, key)
+    cache_path = path.join(_PKGCACHE_DIR, key)
+    await loop.run_in_executor(None, move, src_dir, tmp_path)
+    size = await loop.run_in_executor(None, _dir_size, tmp_path)
+    rename(tmp_path, cache_path)
+    rmdir(tmp_dir)
+    index[key] = size
+    _pin(key)
+    await _evict(index)
+    return cache_path
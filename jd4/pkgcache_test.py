@@ -0,0 +1,86 @@
+from asyncio import get_event_loop
+from os import listdir, makedirs, path
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4 import pkgcache
+from jd4.config import config
+from jd4.util import write_binary_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class PkgcacheTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.old_state = pkgcache._PKGCACHE_DIR, pkgcache._index, \
+                         config.get('package_cache_size')
+        pkgcache._PKGCACHE_DIR = path.join(self.tmp_dir.name, 'cache')
+        pkgcache._index = None
+        config['package_cache_size'] = 2048
+
+    def tearDown(self):
+        pkgcache._PKGCACHE_DIR, pkgcache._index, size = self.old_state
+        if size is None:
+            del config['package_cache_size']
+        else:
+            config['package_cache_size'] = size
+        self.tmp_dir.cleanup()
+
+    def make_package(self, name, size):
+        package_dir = path.join(self.tmp_dir.name, name)
+        makedirs(path.join(package_dir, 'package'))
+        write_binary_file(path.join(package_dir, 'package', 'foo'), b'x' * size)
+        return package_dir
+
+    def test_put_get(self):
+        self.assertIsNone(run(pkgcache.pkgcache_get('a')))
+        cache_path = run(pkgcache.pkgcache_put('a', self.make_package('a', 100)))
+        pkgcache.pkgcache_release('a')
+        self.assertEqual(run(pkgcache.pkgcache_get('a')), cache_path)
+        pkgcache.pkgcache_release('a')
+        with open(path.join(cache_path, 'package', 'foo'), 'rb') as file:
+            self.assertEqual(file.read(), b'x' * 100)
+
+    def test_lru(self):
+        run(pkgcache.pkgcache_put('a', self.make_package('a', 1000)))
+        pkgcache.pkgcache_release('a')
+        run(pkgcache.pkgcache_put('b', self.make_package('b', 1000)))
+        pkgcache.pkgcache_release('b')
+        run(pkgcache.pkgcache_get('a'))
+        pkgcache.pkgcache_release('a')
+        run(pkgcache.pkgcache_put('c', self.make_package('c', 1000)))
+        pkgcache.pkgcache_release('c')
+        self.assertIsNotNone(run(pkgcache.pkgcache_get('a')))
+        pkgcache.pkgcache_release('a')
+        self.assertIsNone(run(pkgcache.pkgcache_get('b')))
+        self.assertIsNotNone(run(pkgcache.pkgcache_get('c')))
+        pkgcache.pkgcache_release('c')
+
+    def test_pinned(self):
+        run(pkgcache.pkgcache_put('a', self.make_package('a', 1500)))
+        run(pkgcache.pkgcache_put('b', self.make_package('b', 1500)))
+        self.assertIsNotNone(run(pkgcache.pkgcache_get('a')))
+        pkgcache.pkgcache_release('a')
+        pkgcache.pkgcache_release('a')
+        pkgcache.pkgcache_release('b')
+
+    def test_evict_during_put(self):
+        run(pkgcache.pkgcache_put('a', self.make_package('a', 1500)))
+        pkgcache.pkgcache_release('a')
+        # Left behind by a put of the same key that has not finished.
+        makedirs(path.join(pkgcache._PKGCACHE_DIR, 'tmp_a', 'package'))
+        run(pkgcache.pkgcache_put('b', self.make_package('b', 1500)))
+        pkgcache.pkgcache_release('b')
+        self.assertIsNone(run(pkgcache.pkgcache_get('a')))
+        self.assertEqual(sorted(listdir(pkgcache._PKGCACHE_DIR)), ['b', 'tmp_a'])
+
+    def test_reload(self):
+        run(pkgcache.pkgcache_put('a', self.make_package('a', 100)))
+        pkgcache.pkgcache_release('a')
+        pkgcache._index = None
+        self.assertIsNotNone(run(pkgcache.pkgcache_get('a')))
+        pkgcache.pkgcache_release('a')
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,224 @@
-from asyncio import gather, get_event_loop, LifoQueue, Lock
+from asyncio import get_event_loop, sleep, CancelledError
+from contextvars import ContextVar
+from heapq import heapify, heappop, heappush
+from itertools import count
+from os import cpu_count, getloadavg
+from time import monotonic, monotonic_ns
 
+from jd4.admin import admin_add_command
+from jd4.cgroup import pin_cpus, read_pressure
 from jd4.config import config
 from jd4.log import logger
 from jd4.sandbox import create_sandboxes
+from jd4.util import parse_memory_bytes
+
+PRIORITIES = {'pretest': 0, 'contest': 1, 'normal': 2, 'rejudge': 3}
+DEFAULT_AGING_SEC = 10
+DEFAULT_RESERVE_SEC = 1
+_priority = ContextVar('priority', default=PRIORITIES['normal'])
+_seq = count()
+_sandboxes = list()
+_waiters = list()
+_blocked = None, 0
+DEFAULT_ADAPT_INTERVAL_SEC = 5
+DEFAULT_PRESSURE_HIGH = 10.
+DEFAULT_PRESSURE_LOW = 1.
+DEFAULT_MIN_AVAILABLE_MEMORY = '1g'
+_busy_since = dict()
+_stats = {'sandboxes': 0, 'busy_ns': 0, 'capacity_ns': 0, 'since_ns': 0}
+_spare_cpus = list()
+_retiring = 0
+_contended = False
+_contended_samples = 0
+
+def set_priority(name):
+    """Sets the priority class of sandbox requests made in the current context."""
+    if name not in PRIORITIES:
+        logger.warning('Unknown priority %r, using normal', name)
+        name = 'normal'
+    _priority.set(PRIORITIES[name])
+
+def _grant(waiter):
+    _, _, n, future = waiter
+    sandboxes = [_sandboxes.pop() for _ in range(n)]
+    now_ns = monotonic_ns()
+    for sandbox in sandboxes:
+        _busy_since[sandbox] = now_ns
+    future.set_result(sandboxes)
+
+def _dispatch():
+    global _blocked
+    while _waiters:
+        waiter = _waiters[0]
+        if waiter[3].done():
+            heappop(_waiters)
+        elif len(_sandboxes) >= waiter[2]:
+            heappop(_waiters)
+            _grant(waiter)
+        else:
+            break
+    if not _waiters or not _sandboxes:
+        return
+    # The best waiter needs more sandboxes than are free. Let smaller
+    # waiters use the free ones meanwhile, until the best waiter has been
+    # blocked for reserve_sec, then hold returned sandboxes for it.
+    seq = _waiters[0][1]
+    if _blocked[0] != seq:
+        _blocked = seq, monotonic()
+    if monotonic() - _blocked[1] >= config.get('reserve_sec', DEFAULT_RESERVE_SEC):
+        return
+    granted = False
+    for waiter in sorted(_waiters)[1:]:
+        if not _sandboxes:
+            break
+        if not waiter[3].done() and len(_sandboxes) >= waiter[2]:
+            _grant(waiter)
+            granted = True
+    if granted:
+        _waiters[:] = [waiter for waiter in _waiters if not waiter[3].done()]
+        heapify(_waiters)
 
 async def get_sandbox(n):
-    await _lock.acquire()
+    # A waiter that arrived aging_sec earlier is equal to one of the next
+    # better priority class, so every class is eventually served.
+    aging_sec = config.get('priority_aging_sec', DEFAULT_AGING_SEC)
+    future = get_event_loop().create_future()
+    heappush(_waiters, (_priority.get() * aging_sec + monotonic(), next(_seq), n, future))
+    _dispatch()
     try:
-        return await gather(*list(_queue.get() for _ in range(n)))
-    finally:
-        _lock.release()
+        return await future
+    except CancelledError:
+        if future.done() and not future.cancelled():
+            put_sandbox(*future.result())
+        else:
+            future.cancel()
+            _dispatch()
+        raise
 
 def put_sandbox(*sandboxes):
+    now_ns = monotonic_ns()
     for sandbox in sandboxes:
-        _queue.put_nowait(sandbox)
+        since_ns = _busy_since.pop(sandbox, None)
+        if since_ns is not None:
+            _stats['busy_ns'] += now_ns - since_ns
+    _sandboxes.extend(sandboxes)
+    _retire_idle()
+    _dispatch()
+
+def _resize(delta):
+    now_ns = monotonic_ns()
+    _stats['capacity_ns'] += _stats['sandboxes'] * (now_ns - _stats['since_ns'])
+    _stats['sandboxes'] += delta
+    _stats['since_ns'] = now_ns
+
+def _retire_idle():
+    global _retiring
+    while _retiring and _sandboxes:
+        # The bottom of the stack is the coldest sandbox.
+        sandbox = _sandboxes.pop(0)
+        _retiring -= 1
+        _resize(-1)
+        if sandbox.cpus:
+            _spare_cpus.append(sandbox.cpus)
+        get_event_loop().create_task(sandbox.close())
+        logger.info('Retired a sandbox, %d left', _stats['sandboxes'])
+
+async def _grow():
+    global _retiring
+    if _retiring:
+        _retiring -= 1
+        return
+    sandbox, = await create_sandboxes(1)
+    if _spare_cpus:
+        sandbox.cpus = _spare_cpus.pop()
+    _resize(1)
+    logger.info('Added a sandbox, %d in total', _stats['sandboxes'])
+    put_sandbox(sandbox)
+
+def _available_memory_bytes():
+    with open('/proc/meminfo') as file:
+        for line in file:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+async def _adapt(min_parallelism, max_parallelism):
+    global _contended, _contended_samples, _retiring
+    interval_sec = config.get('adapt_interval_sec', DEFAULT_ADAPT_INTERVAL_SEC)
+    pressure_high = config.get('pressure_high', DEFAULT_PRESSURE_HIGH)
+    pressure_low = config.get('pressure_low', DEFAULT_PRESSURE_LOW)
+    min_available_bytes = parse_memory_bytes(str(config.get(
+        'min_available_memory', DEFAULT_MIN_AVAILABLE_MEMORY)))
+    while True:
+        await sleep(interval_sec)
+        pressure = max(read_pressure('cpu'), read_pressure('memory'))
+        available_bytes = _available_memory_bytes()
+        _contended = pressure >= pressure_high
+        if _contended:
+            _contended_samples += 1
+        size = _stats['sandboxes'] - _retiring
+        if (_contended or available_bytes < min_available_bytes) and size > min_parallelism:
+            logger.info('Shrinking pool, pressure %.2f%%, %d bytes available',
+                        pressure, available_bytes)
+            _retiring += 1
+            _retire_idle()
+        elif (pressure < pressure_low and size < max_parallelism and
+              any(not waiter[3].done() for waiter in _waiters) and
+              cpu_count() - getloadavg()[0] >= 1 and
+              available_bytes >= 2 * min_available_bytes):
+            await _grow()
+
+async def resize(parallelism):
+    global _retiring
+    if parallelism < 1:
+        raise ValueError('parallelism must be positive')
+    size = _stats['sandboxes'] - _retiring
+    logger.info('Resizing pool from %d to %d', size, parallelism)
+    for _ in range(size, parallelism):
+        await _grow()
+    if size > parallelism:
+        _retiring += size - parallelism
+        _retire_idle()
+    return pool_stats()
+
+def pool_contention():
+    """Returns a token for pool_contended_since, taken when a case starts."""
+    return _contended, _contended_samples
+
+def pool_contended_since(token):
+    """Returns whether the pressure sample current when the token was taken,
+    or any sample after it, showed contention."""
+    contended, samples = token
+    return contended or _contended_samples > samples
+
+def pool_stats():
+    now_ns = monotonic_ns()
+    busy_ns = _stats['busy_ns'] + sum(now_ns - since_ns for since_ns in _busy_since.values())
+    total_ns = _stats['capacity_ns'] + _stats['sandboxes'] * (now_ns - _stats['since_ns'])
+    return {'sandboxes': _stats['sandboxes'],
+            'idle': len(_sandboxes),
+            'waiters': sum(1 for waiter in _waiters if not waiter[3].done()),
+            'busy_ns': busy_ns,
+            'utilization': busy_ns / total_ns if total_ns else 0}
 
 def init():
     parallelism = config.get('parallelism', 2)
-    if parallelism < 2:
+    min_parallelism = config.get('min_parallelism', parallelism)
+    max_parallelism = config.get('max_parallelism', parallelism)
+    if min_parallelism < 2:
         logger.warning('Parallelism less than 2, custom judge will not be supported.')
     logger.info('Using parallelism: %d', parallelism)
+    loop = get_event_loop()
     sandboxes_task = create_sandboxes(parallelism)
-    global _lock, _queue
-    _lock = Lock()
-    _queue = LifoQueue()
-    put_sandbox(*get_event_loop().run_until_complete(sandboxes_task))
+    sandboxes = loop.run_until_complete(sandboxes_task)
+    if config.get('cpu_pinning', False):
+        slot_cpus = pin_cpus(max(parallelism, max_parallelism), config.get('daemon_cores', 1))
+        for sandbox, cpus in zip(sandboxes, slot_cpus):
+            sandbox.cpus = cpus
+        _spare_cpus.extend(reversed(slot_cpus[parallelism:]))
+    _resize(len(sandboxes))
+    put_sandbox(*sandboxes)
+    admin_add_command('resize', resize)
+    if min_parallelism != max_parallelism:
+        logger.info('Adapting parallelism between %d and %d', min_parallelism, max_parallelism)
+        loop.create_task(_adapt(min_parallelism, max_parallelism))
@@ -0,0 +1,146 @@
+from asyncio import get_event_loop, sleep, CancelledError
+from unittest import main, TestCase
+
+from jd4 import pool
+from jd4.config import config
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class PoolTest(TestCase):
+    def setUp(self):
+        self.old_state = pool._sandboxes, pool._waiters, pool._busy_since, pool._stats, \
+                         pool._spare_cpus, pool._retiring
+        pool._sandboxes = list()
+        pool._waiters = list()
+        pool._busy_since = dict()
+        pool._stats = dict(pool._stats)
+        pool._spare_cpus = list()
+
+    def tearDown(self):
+        pool._sandboxes, pool._waiters, pool._busy_since, pool._stats, \
+            pool._spare_cpus, pool._retiring = self.old_state
+        config.pop('priority_aging_sec', None)
+        config.pop('reserve_sec', None)
+
+    def request(self, name, n, order):
+        async def get():
+            pool.set_priority(name)
+            sandboxes = await pool.get_sandbox(n)
+            order.append(name)
+            await sleep(0)
+            pool.put_sandbox(*sandboxes)
+        return get_event_loop().create_task(get())
+
+    def test_priority(self):
+        async def test():
+            order = list()
+            tasks = [self.request(name, 1, order)
+                     for name in ('rejudge', 'normal', 'pretest', 'contest')]
+            await sleep(0)
+            pool.put_sandbox(object())
+            for task in tasks:
+                await task
+            return order
+        self.assertEqual(run(test()), ['pretest', 'contest', 'normal', 'rejudge'])
+
+    def test_aging(self):
+        config['priority_aging_sec'] = 0.01
+        async def test():
+            order = list()
+            tasks = [self.request('rejudge', 1, order)]
+            await sleep(0.05)
+            tasks.append(self.request('pretest', 1, order))
+            await sleep(0)
+            pool.put_sandbox(object())
+            for task in tasks:
+                await task
+            return order
+        self.assertEqual(run(test()), ['rejudge', 'pretest'])
+
+    def test_cancel(self):
+        async def test():
+            task = get_event_loop().create_task(pool.get_sandbox(2))
+            await sleep(0)
+            pool.put_sandbox(object())
+            task.cancel()
+            try:
+                await task
+            except CancelledError:
+                pass
+            return await pool.get_sandbox(1)
+        self.assertEqual(len(run(test())), 1)
+
+    def test_backfill(self):
+        async def test():
+            pool.put_sandbox(object())
+            pair_task = get_event_loop().create_task(pool.get_sandbox(2))
+            await sleep(0)
+            single, = await pool.get_sandbox(1)
+            self.assertFalse(pair_task.done())
+            pool.put_sandbox(single, object())
+            return await pair_task
+        self.assertEqual(len(run(test())), 2)
+
+    def test_reserve(self):
+        config['reserve_sec'] = 0
+        async def test():
+            pool.put_sandbox(object())
+            pair_task = get_event_loop().create_task(pool.get_sandbox(2))
+            await sleep(0)
+            single_task = get_event_loop().create_task(pool.get_sandbox(1))
+            await sleep(0)
+            self.assertFalse(single_task.done())
+            pool.put_sandbox(object())
+            pool.put_sandbox(*await pair_task)
+            return await single_task
+        self.assertEqual(len(run(test())), 1)
+
+    def test_unknown_priority(self):
+        pool.set_priority('rejudge')
+        pool.set_priority('urgent')
+        self.assertEqual(pool._priority.get(), pool.PRIORITIES['normal'])
+
+    def test_stats(self):
+        pool.put_sandbox(object())
+        sandbox, = run(pool.get_sandbox(1))
+        self.assertEqual(pool.pool_stats()['idle'], 0)
+        pool.put_sandbox(sandbox)
+        self.assertEqual(pool.pool_stats()['idle'], 1)
+        self.assertGreater(pool.pool_stats()['busy_ns'], 0)
+
+    def test_contention(self):
+        old_state = pool._contended, pool._contended_samples
+        try:
+            token = pool.pool_contention()
+            self.assertFalse(pool.pool_contended_since(token))
+            pool._contended, pool._contended_samples = True, pool._contended_samples + 1
+            self.assertTrue(pool.pool_contended_since(token))
+            token = pool.pool_contention()
+            pool._contended = False
+            self.assertTrue(pool.pool_contended_since(token))
+            self.assertFalse(pool.pool_contended_since(pool.pool_contention()))
+        finally:
+            pool._contended, pool._contended_samples = old_state
+
+    def test_retire(self):
+        closed = list()
+        class FakeSandbox:
+            cpus = '1'
+            async def close(self):
+                closed.append(self)
+        pool.put_sandbox(FakeSandbox(), FakeSandbox())
+        pool._stats['sandboxes'] = 2
+        pool._retiring = 1
+        sandbox, = run(pool.get_sandbox(1))
+        pool.put_sandbox(sandbox)
+        self.assertEqual(len(pool._sandboxes), 1)
+        self.assertEqual(pool._retiring, 0)
+        self.assertEqual(pool._stats['sandboxes'], 1)
+        self.assertEqual(pool._spare_cpus, ['1'])
+        run(sleep(0))
+        self.assertEqual(len(closed), 1)
+        self.assertIsNot(closed[0], pool._sandboxes[0])
+
+if __name__ == '__main__':
+    main()
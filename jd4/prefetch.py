@@ -0,0 +1,75 @@
+from asyncio import get_event_loop, sleep, Event
+from collections import OrderedDict
+from time import monotonic
+
+from jd4.cache import cache_checkers, cache_downloading
+from jd4.config import config
+from jd4.log import logger
+from jd4.store import store_cases
+
+DEFAULT_HALF_LIFE_SEC = 3600
+DEFAULT_CONCURRENCY = 1
+DEFAULT_MAX_PENDING = 100
+MIN_SCORE = 0.1
+MAX_SEEN = 10000
+BUSY_DELAY_SEC = 1
+_seen = OrderedDict()
+_pending = dict()
+_wakeup = None
+_active = 0
+
+def _score(key, now):
+    score, time = _seen.get(key, (0, now))
+    return score * 0.5 ** ((now - time) / config.get('prefetch_half_life_sec',
+                                                      DEFAULT_HALF_LIFE_SEC))
+
+def prefetch_seen(domain_id, pid):
+    """Counts a submission, the count halves every prefetch_half_life_sec."""
+    key = domain_id, pid
+    now = monotonic()
+    _seen[key] = _score(key, now) + 1, now
+    _seen.move_to_end(key)
+    while len(_seen) > MAX_SEEN:
+        _seen.popitem(last=False)
+
+def prefetch_invalidated(domain_id, pid, force=False):
+    """Schedules a download of invalidated data if it was judged recently or forced."""
+    key = domain_id, pid
+    score = _score(key, monotonic())
+    if not force and score < MIN_SCORE:
+        return
+    _pending[key] = score
+    if len(_pending) > config.get('prefetch_max_pending', DEFAULT_MAX_PENDING):
+        del _pending[min(_pending, key=_pending.get)]
+    if _wakeup:
+        _wakeup.set()
+
+async def _worker(session):
+    global _active
+    while True:
+        while not _pending:
+            _wakeup.clear()
+            await _wakeup.wait()
+        # Downloads of judging requests come first.
+        while cache_downloading() > _active:
+            await sleep(BUSY_DELAY_SEC)
+        if not _pending:
+            continue
+        key = max(_pending, key=_pending.get)
+        del _pending[key]
+        domain_id, pid = key
+        _active += 1
+        try:
+            await store_cases(session, domain_id, pid, cache_checkers(domain_id, pid))
+            logger.info('Prefetched %s/%s', domain_id, pid)
+        except Exception as e:
+            logger.warning('Failed to prefetch %s/%s: %r', domain_id, pid, e)
+        finally:
+            _active -= 1
+
+def start_prefetch(session):
+    global _wakeup
+    loop = get_event_loop()
+    _wakeup = Event()
+    return [loop.create_task(_worker(session))
+            for _ in range(config.get('prefetch_concurrency', DEFAULT_CONCURRENCY))]
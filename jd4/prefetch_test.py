@@ -0,0 +1,58 @@
+from asyncio import get_event_loop, sleep
+from unittest import main, TestCase
+
+from jd4 import prefetch
+from jd4.config import config
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class PrefetchTest(TestCase):
+    def setUp(self):
+        self.old_state = prefetch._seen, prefetch._pending, prefetch._wakeup, \
+                         prefetch.store_cases
+        prefetch._seen = type(prefetch._seen)()
+        prefetch._pending = dict()
+        prefetch._wakeup = None
+        self.fetched = list()
+        async def store_cases(session, domain_id, pid, checkers):
+            self.fetched.append((domain_id, pid))
+        prefetch.store_cases = store_cases
+
+    def tearDown(self):
+        prefetch._seen, prefetch._pending, prefetch._wakeup, \
+            prefetch.store_cases = self.old_state
+        config.pop('prefetch_max_pending', None)
+
+    def test_only_seen(self):
+        prefetch.prefetch_seen('system', '1')
+        prefetch.prefetch_invalidated('system', '1')
+        prefetch.prefetch_invalidated('system', '2')
+        self.assertEqual(list(prefetch._pending), [('system', '1')])
+        prefetch.prefetch_invalidated('system', '2', force=True)
+        self.assertEqual(len(prefetch._pending), 2)
+
+    def test_max_pending(self):
+        config['prefetch_max_pending'] = 1
+        prefetch.prefetch_seen('system', '1')
+        prefetch.prefetch_seen('system', '2')
+        prefetch.prefetch_seen('system', '2')
+        prefetch.prefetch_invalidated('system', '2')
+        prefetch.prefetch_invalidated('system', '1')
+        self.assertEqual(list(prefetch._pending), [('system', '2')])
+
+    def test_rank(self):
+        async def test():
+            for pid, count in (('1', 1), ('2', 3), ('3', 2)):
+                for _ in range(count):
+                    prefetch.prefetch_seen('system', pid)
+                prefetch.prefetch_invalidated('system', pid)
+            tasks = prefetch.start_prefetch(None)
+            await sleep(0.01)
+            for task in tasks:
+                task.cancel()
+        run(test())
+        self.assertEqual(self.fetched, [('system', '2'), ('system', '3'), ('system', '1')])
+
+if __name__ == '__main__':
+    main()
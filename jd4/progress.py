@@ -0,0 +1,79 @@
+from asyncio import get_event_loop
+from time import monotonic
+
+from jd4.config import config
+
+DEFAULT_INTERVAL_SEC = 0
+DEFAULT_BATCH_SIZE = 50
+
+class ProgressBatcher:
+    """Coalesces next messages of a record.
+
+    With progress_cases_list, consecutive case results and progress updates
+    are held and sent as one next message with a cases list, at most once
+    per progress_interval_sec or every progress_batch_size cases. Status
+    transitions and texts are sent immediately. Without it, or with an
+    interval of 0, every message is sent as is, since a server without
+    cases lists needs a message per case anyway."""
+
+    def __init__(self, send):
+        self.send = send
+        self.interval_sec = config.get('progress_interval_sec', DEFAULT_INTERVAL_SEC)
+        self.batch_size = config.get('progress_batch_size', DEFAULT_BATCH_SIZE)
+        self.cases_list = config.get('progress_cases_list', False)
+        self.pending = None
+        self.status = None
+        self.sent_at = 0
+        self.timer = None
+        self.flushing = None
+
+    async def next(self, **kwargs):
+        status = kwargs.get('status', self.status)
+        transition = status != self.status
+        self.status = status
+        if not self.interval_sec or not self.cases_list:
+            await self.send(kwargs)
+            return
+        if transition or set(kwargs) - {'status', 'case', 'progress'}:
+            await self.flush()
+            self.sent_at = monotonic()
+            await self.send(kwargs)
+            return
+        if self.pending is None:
+            self.pending = {'cases': list()}
+        if 'case' in kwargs:
+            self.pending['cases'].append(kwargs.pop('case'))
+        self.pending.update(kwargs)
+        if (len(self.pending['cases']) >= self.batch_size or
+                monotonic() - self.sent_at >= self.interval_sec):
+            await self.flush()
+        elif not self.timer:
+            self.timer = get_event_loop().call_later(
+                self.sent_at + self.interval_sec - monotonic(), self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self.flushing = get_event_loop().create_task(self._flush(self.flushing))
+
+    async def flush(self):
+        """Sends the held messages after any flush still in flight."""
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        flushing, self.flushing = self.flushing, None
+        await self._flush(flushing)
+
+    async def _flush(self, previous):
+        # Flushes run one after another, which also raises their errors.
+        if previous:
+            await previous
+        if self.pending is None:
+            return
+        message, self.pending = self.pending, None
+        cases = message.pop('cases')
+        self.sent_at = monotonic()
+        if len(cases) > 1:
+            message['cases'] = cases
+        elif cases:
+            message['case'] = cases[0]
+        await self.send(message)
@@ -0,0 +1,120 @@
+from asyncio import get_event_loop, sleep
+from unittest import main, TestCase
+
+from jd4.config import config
+from jd4.progress import ProgressBatcher
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class ProgressTest(TestCase):
+    def setUp(self):
+        self.sent = list()
+        config['progress_interval_sec'] = 60
+        config['progress_batch_size'] = 3
+        config['progress_cases_list'] = True
+
+    def tearDown(self):
+        config.pop('progress_interval_sec', None)
+        config.pop('progress_batch_size', None)
+        config.pop('progress_cases_list', None)
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    def test_disabled(self):
+        config['progress_interval_sec'] = 0
+        batcher = ProgressBatcher(self.send)
+        run(batcher.next(status=20, progress=0))
+        run(batcher.next(status=20, case={'score': 10}, progress=50))
+        self.assertEqual(self.sent, [{'status': 20, 'progress': 0},
+                                     {'status': 20, 'case': {'score': 10}, 'progress': 50}])
+
+    def test_batch(self):
+        batcher = ProgressBatcher(self.send)
+        run(batcher.next(status=20, progress=0))
+        for index in range(4):
+            run(batcher.next(status=20, case={'score': index}, progress=index * 25 + 25))
+        self.assertEqual(self.sent, [{'status': 20, 'progress': 0},
+                                     {'status': 20,
+                                      'cases': [{'score': 0}, {'score': 1}, {'score': 2}],
+                                      'progress': 75}])
+        run(batcher.flush())
+        self.assertEqual(self.sent[2], {'status': 20, 'case': {'score': 3}, 'progress': 100})
+        run(batcher.flush())
+        self.assertEqual(len(self.sent), 3)
+
+    def test_no_cases_list(self):
+        config['progress_cases_list'] = False
+        batcher = ProgressBatcher(self.send)
+        run(batcher.next(status=20, progress=0))
+        for index in range(3):
+            run(batcher.next(status=20, case={'score': index}, progress=index * 25 + 25))
+        self.assertEqual(self.sent[1:], [
+            {'status': 20, 'case': {'score': index}, 'progress': index * 25 + 25}
+            for index in range(3)])
+
+    def test_transition(self):
+        batcher = ProgressBatcher(self.send)
+        run(batcher.next(status=20, progress=0))
+        run(batcher.next(status=20, case={'score': 0}, progress=50))
+        run(batcher.next(status=21))
+        self.assertEqual(self.sent, [{'status': 20, 'progress': 0},
+                                     {'status': 20, 'case': {'score': 0}, 'progress': 50},
+                                     {'status': 21}])
+
+    def test_text(self):
+        batcher = ProgressBatcher(self.send)
+        run(batcher.next(status=20, progress=0))
+        run(batcher.next(status=20, case={'score': 0}))
+        run(batcher.next(judge_text='foo'))
+        self.assertEqual(self.sent[1:], [{'status': 20, 'case': {'score': 0}},
+                                         {'judge_text': 'foo'}])
+
+    def test_interval(self):
+        config['progress_interval_sec'] = 0.05
+        batcher = ProgressBatcher(self.send)
+        run(batcher.next(status=20, progress=0))
+        run(batcher.next(status=20, case={'score': 0}, progress=50))
+        self.assertEqual(len(self.sent), 1)
+        run(sleep(0.1))
+        self.assertEqual(self.sent[1], {'status': 20, 'case': {'score': 0}, 'progress': 50})
+
+    def test_flush_in_flight(self):
+        config['progress_interval_sec'] = 0.01
+
+        async def send(message):
+            if 'case' in message:
+                await sleep(0.05)
+            self.sent.append(message)
+
+        async def judge():
+            batcher = ProgressBatcher(send)
+            await batcher.next(status=20, progress=0)
+            await batcher.next(status=20, case={'score': 0}, progress=50)
+            await sleep(0.02)
+            await batcher.flush()
+            await send({'key': 'end'})
+        run(judge())
+        self.assertEqual(self.sent, [{'status': 20, 'progress': 0},
+                                     {'status': 20, 'case': {'score': 0}, 'progress': 50},
+                                     {'key': 'end'}])
+
+    def test_flush_error(self):
+        config['progress_interval_sec'] = 0.01
+
+        async def send(message):
+            if 'case' in message:
+                raise ConnectionResetError()
+
+        async def judge():
+            batcher = ProgressBatcher(send)
+            await batcher.next(status=20, progress=0)
+            await batcher.next(status=20, case={'score': 0}, progress=50)
+            await sleep(0.02)
+            with self.assertRaises(ConnectionResetError):
+                await batcher.flush()
+        run(judge())
+
+if __name__ == '__main__':
+    main()
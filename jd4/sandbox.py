@@ -1,19 +1,21 @@
 import pickle
-from asyncio import gather, get_event_loop, open_connection
-from os import close as os_close, chdir, dup2, execve, fork, mkdir, \
-               open as os_open, path, set_inheritable, spawnve, waitpid, \
-               O_RDONLY, O_WRONLY, P_WAIT
+from asyncio import gather, get_event_loop, open_connection, IncompleteReadError
+from os import close as os_close, chdir, dup2, execve, fork, listdir, mkdir, \
+               open as os_open, path, rename, set_inheritable, spawnve, waitpid, \
+               _exit, O_RDONLY, O_WRONLY, P_WAIT
 from pty import STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO
 from shutil import rmtree
 from socket import socketpair
-from struct import pack, unpack
+from struct import calcsize, pack, unpack
 from sys import exit
 from tempfile import mkdtemp
+from time import perf_counter_ns
 
-from jd4._sandbox import create_namespace, enter_namespace
+from jd4._sandbox import create_namespace, enter_namespace, mount_tmpfs, umount_detach
 from jd4.cgroup import enter_cgroup
 from jd4.log import logger
-from jd4.util import remove_under, wait_and_reap_zombies
+from jd4.metrics import metrics_observe
+from jd4.util import wait_and_reap_zombies
 
 EXTRA_FILENO = 3
 SPAWN_ENV = {'PATH': '/usr/bin:/bin', 'HOME': '/'}
@@ -22,6 +24,13 @@ SANDBOX_BACKDOOR = 1
 SANDBOX_RESET_CHILD = 2
 SANDBOX_COMPILE = 3
 SANDBOX_EXECUTE = 4
+SANDBOX_NOOP = 5
+
+FRAME_HEADER = '<II'
+FRAME_HEADER_SIZE = calcsize(FRAME_HEADER)
+TMPFS_OPTIONS = 'size=16m,nr_inodes=4k'
+_reset_stats = {'count': 0, 'total_ns': 0, 'max_ns': 0}
+_out_stacked = False
 
 class Sandbox:
     def __init__(self, pid, sandbox_dir, in_dir, out_dir, reader, writer):
@@ -31,33 +40,137 @@ class Sandbox:
         self.out_dir = out_dir
         self.reader = reader
         self.writer = writer
+        self.package = None
+        self.cgroup = None
+        self.cpus = None
+        self.next_request_id = 0
+        self.pending = dict()
+        self.unchecked = list()
+        self.closed = False
+        self.reader_task = get_event_loop().create_task(
+            _read_replies(reader, self.pending))
 
     def __del__(self):
+        if self.closed:
+            return
+        if self.cgroup:
+            self.cgroup.close()
         self.writer.write_eof()
         waitpid(self.pid, 0)
         rmtree(self.sandbox_dir)
 
-    async def reset(self):
+    async def close(self):
+        """Stops the sandbox process and removes its directory off the event loop."""
+        loop = get_event_loop()
+        self.closed = True
+        if self.cgroup:
+            self.cgroup.close()
+            self.cgroup = None
+        self.writer.write_eof()
+        await self.writer.drain()
+        await loop.run_in_executor(None, waitpid, self.pid, 0)
+        await self.reader_task
+        self.writer.close()
+        # A background trash removal may still be running in the directory.
+        await loop.run_in_executor(None, rmtree, self.sandbox_dir, True)
+
+    def _move_to_trash(self, keep_package):
+        trash_dir = mkdtemp(prefix='trash.', dir=self.sandbox_dir)
+        for dirname in self.in_dir, self.out_dir:
+            trash_subdir = path.join(trash_dir, path.basename(dirname))
+            mkdir(trash_subdir)
+            for name in listdir(dirname):
+                if keep_package and dirname == self.in_dir and name == 'package':
+                    continue
+                rename(path.join(dirname, name), path.join(trash_subdir, name))
+        return trash_dir
+
+    async def reset(self, keep_package=False, out_tmpfs=True):
         loop = get_event_loop()
-        await gather(loop.run_in_executor(None, remove_under, self.in_dir, self.out_dir),
-                     self.call(SANDBOX_RESET_CHILD))
+        start_ns = perf_counter_ns()
+        if not keep_package:
+            self.package = None
+        reset_future = self.send((SANDBOX_RESET_CHILD, out_tmpfs))
+        reset_future.add_done_callback(lambda _: _record_reset(start_ns))
+        self.unchecked.append(reset_future)
+        trash_dir = await loop.run_in_executor(None, self._move_to_trash, keep_package)
+        loop.run_in_executor(None, rmtree, trash_dir, True)
+
+    def send(self, *commands):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        data = pickle.dumps(commands)
+        self.writer.write(pack(FRAME_HEADER, request_id, len(data)) + data)
+        future = get_event_loop().create_future()
+        self.pending[request_id] = future
+        return future
+
+    async def batch(self, *commands):
+        results = await self.send(*commands)
+        unchecked, self.unchecked = self.unchecked, list()
+        for future in unchecked:
+            if future.done():
+                _check_results(future.result())
+            else:
+                self.unchecked.append(future)
+        return _check_results(results)
 
     async def call(self, command, *args):
-        pickle.dump((command, *args), self.writer)
-        length, = unpack('I', await self.reader.read(4))
-        ret, err = pickle.loads(await self.reader.read(length))
-        if err:
-            raise err
+        ret, = await self.batch((command, *args))
         return ret
 
+    async def noop(self):
+        return await self.call(SANDBOX_NOOP)
+
     async def backdoor(self):
         return await self.call(SANDBOX_BACKDOOR)
 
+def reset_stats():
+    return dict(_reset_stats)
+
+def _record_reset(start_ns):
+    reset_ns = perf_counter_ns() - start_ns
+    _reset_stats['count'] += 1
+    _reset_stats['total_ns'] += reset_ns
+    _reset_stats['max_ns'] = max(_reset_stats['max_ns'], reset_ns)
+    metrics_observe('reset', reset_ns / 1e9)
+
+def _check_results(results):
+    for _, err in results:
+        if err:
+            raise err
+    return [ret for ret, _ in results]
+
+async def _read_replies(reader, pending):
+    try:
+        while True:
+            request_id, length = unpack(FRAME_HEADER,
+                                        await reader.readexactly(FRAME_HEADER_SIZE))
+            results = pickle.loads(await reader.readexactly(length))
+            future = pending.pop(request_id)
+            if not future.cancelled():
+                future.set_result(results)
+    except IncompleteReadError:
+        pass
+    for future in pending.values():
+        if not future.cancelled():
+            future.set_exception(ConnectionError('sandbox closed'))
+    pending.clear()
+
 def _handle_backdoor():
     return spawnve(P_WAIT, '/bin/bash', ['bunny'], SPAWN_ENV)
 
-def _handle_reset_child():
-    remove_under('/tmp')
+def _handle_reset_child(out_tmpfs):
+    global _out_stacked
+    for target in '/tmp', '/.cache':
+        umount_detach(target)
+        mount_tmpfs(target, TMPFS_OPTIONS)
+    if _out_stacked:
+        umount_detach('/out')
+        _out_stacked = False
+    if out_tmpfs:
+        mount_tmpfs('/out', TMPFS_OPTIONS)
+        _out_stacked = True
 
 def _handle_compile(compiler_file, compiler_args, output_file, cgroup_file):
     pid = fork()
@@ -115,37 +228,62 @@ def _handle_execute(execute_file,
             exit(1)
     return wait_and_reap_zombies(pid)
 
+def _handle_noop():
+    pass
+
 _HANDLERS = {
     SANDBOX_BACKDOOR: _handle_backdoor,
     SANDBOX_RESET_CHILD: _handle_reset_child,
     SANDBOX_COMPILE: _handle_compile,
     SANDBOX_EXECUTE: _handle_execute,
+    SANDBOX_NOOP: _handle_noop,
 }
 
+def _read_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise EOFError()
+    return data
+
 def _handle_child(child_socket, root_dir, in_dir, out_dir):
     create_namespace()
     pid = fork()
     if pid != 0:
         child_socket.close()
         waitpid(pid, 0)
-        return exit()
+        _exit(0)
 
     enter_namespace(root_dir, in_dir, out_dir)
     socket_file = child_socket.makefile('rwb')
     while True:
         try:
-            command, *args = pickle.load(socket_file)
+            request_id, length = unpack(FRAME_HEADER,
+                                        _read_exactly(socket_file, FRAME_HEADER_SIZE))
+            commands = pickle.loads(_read_exactly(socket_file, length))
         except EOFError:
-            return exit()
-        try:
-            ret, err = _HANDLERS[command](*args), None
-        except Exception as e:
-            ret, err = None, e
-        data = pickle.dumps((ret, err))
-        socket_file.write(pack('I', len(data)))
-        socket_file.write(data)
+            # Skip the cleanup of objects inherited from the daemon.
+            _exit(0)
+        results = list()
+        for command, *args in commands:
+            try:
+                results.append((_HANDLERS[command](*args), None))
+            except Exception as e:
+                results.append((None, e))
+                break
+        data = pickle.dumps(results)
+        socket_file.write(pack(FRAME_HEADER, request_id, len(data)) + data)
         socket_file.flush()
 
+def _close_inherited_fds(keep_fd):
+    # The daemon may be running, do not leak its sockets into the sandbox.
+    for name in listdir('/proc/self/fd'):
+        fd = int(name)
+        if fd > STDERR_FILENO and fd != keep_fd:
+            try:
+                os_close(fd)
+            except OSError:
+                pass
+
 def create_sandboxes(n):
     parent_sockets = list()
     sandbox_params = list()
@@ -162,8 +300,7 @@ def create_sandboxes(n):
 
         pid = fork()
         if pid == 0:
-            for parent_socket in parent_sockets:
-                parent_socket.close()
+            _close_inherited_fds(child_socket.fileno())
             _handle_child(child_socket, root_dir, in_dir, out_dir)
         child_socket.close()
         sandbox_params.append((pid, sandbox_dir, in_dir, out_dir, parent_socket))
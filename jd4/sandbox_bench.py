@@ -0,0 +1,35 @@
+from asyncio import gather, get_event_loop
+from time import perf_counter
+
+from jd4.log import logger
+from jd4.sandbox import create_sandboxes, SANDBOX_NOOP
+
+ROUNDS = 10000
+
+def report(name, elapsed):
+    logger.info('%s: %.1f us per call', name, elapsed / ROUNDS * 1e6)
+
+async def main():
+    sandbox, = await create_sandboxes(1)
+
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        await sandbox.noop()
+    report('sequential', perf_counter() - start)
+
+    start = perf_counter()
+    await gather(*(sandbox.noop() for _ in range(ROUNDS)))
+    report('pipelined', perf_counter() - start)
+
+    start = perf_counter()
+    await sandbox.batch(*((SANDBOX_NOOP,) for _ in range(ROUNDS)))
+    report('batched', perf_counter() - start)
+
+    start = perf_counter()
+    for _ in range(ROUNDS // 10):
+        await sandbox.reset()
+        await sandbox.noop()
+    report('reset and noop', (perf_counter() - start) * 10)
+
+if __name__ == '__main__':
+    get_event_loop().run_until_complete(main())
@@ -0,0 +1,123 @@
+import pickle
+from asyncio import gather, get_event_loop, open_connection, sleep
+from os import listdir, makedirs, path
+from socket import socketpair
+from struct import pack, unpack
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4.sandbox import reset_stats, Sandbox, FRAME_HEADER, FRAME_HEADER_SIZE, \
+                        SANDBOX_NOOP, SANDBOX_RESET_CHILD
+from jd4.util import write_binary_file
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class SandboxTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.sandbox_dir = self.tmp_dir.name
+        in_dir = path.join(self.sandbox_dir, 'in')
+        out_dir = path.join(self.sandbox_dir, 'out')
+        makedirs(in_dir)
+        makedirs(out_dir)
+        sock, self.child_sock = socketpair()
+        reader, writer = run(open_connection(sock=sock))
+        self.child_reader, self.child_writer = run(open_connection(sock=self.child_sock))
+        self.sandbox = Sandbox(0, self.sandbox_dir, in_dir, out_dir, reader, writer)
+
+    def tearDown(self):
+        self.sandbox.closed = True
+        self.sandbox.writer.close()
+        self.child_writer.close()
+        run(self.sandbox.reader_task)
+        self.tmp_dir.cleanup()
+
+    async def receive(self):
+        request_id, length = unpack(FRAME_HEADER,
+                                    await self.child_reader.readexactly(FRAME_HEADER_SIZE))
+        return request_id, pickle.loads(await self.child_reader.readexactly(length))
+
+    def reply(self, request_id, results):
+        data = pickle.dumps(results)
+        self.child_writer.write(pack(FRAME_HEADER, request_id, len(data)) + data)
+
+    def test_pipelined(self):
+        async def calls():
+            return await gather(self.sandbox.call(SANDBOX_NOOP),
+                                self.sandbox.batch((SANDBOX_NOOP,), (SANDBOX_NOOP,)))
+
+        async def supervisor():
+            first_id, first = await self.receive()
+            second_id, second = await self.receive()
+            self.assertEqual(first, ((SANDBOX_NOOP,),))
+            self.assertEqual(second, ((SANDBOX_NOOP,), (SANDBOX_NOOP,)))
+            data = pickle.dumps([(2, None), (3, None)])
+            frame = pack(FRAME_HEADER, second_id, len(data)) + data
+            for index in range(len(frame)):
+                self.child_writer.write(frame[index:index + 1])
+                await sleep(0)
+            self.reply(first_id, [(1, None)])
+        results, _ = run(gather(calls(), supervisor()))
+        self.assertEqual(results, [1, [2, 3]])
+
+    def test_error(self):
+        async def calls():
+            await self.sandbox.reset()
+            with self.assertRaisesRegex(ValueError, 'reset failed'):
+                await self.sandbox.noop()
+            with self.assertRaisesRegex(ValueError, 'noop failed'):
+                await self.sandbox.noop()
+
+        async def supervisor():
+            reset_id, _ = await self.receive()
+            self.reply(reset_id, [(None, ValueError('reset failed'))])
+            for _ in range(2):
+                request_id, _ = await self.receive()
+                self.reply(request_id, [(None, ValueError('noop failed'))])
+        run(gather(calls(), supervisor()))
+
+    def test_closed(self):
+        async def call():
+            with self.assertRaises(ConnectionError):
+                await self.sandbox.noop()
+
+        async def supervisor():
+            await self.receive()
+            self.child_writer.close()
+        run(gather(call(), supervisor()))
+
+    def test_reset(self):
+        write_binary_file(path.join(self.sandbox.in_dir, 'stdin'), b'')
+        makedirs(path.join(self.sandbox.in_dir, 'package', 'lib'))
+        makedirs(path.join(self.sandbox.out_dir, 'foo', 'bar'))
+        self.sandbox.package = object
+        count = reset_stats()['count']
+
+        async def reset():
+            await self.sandbox.reset(keep_package=True)
+            request_id, commands = await self.receive()
+            self.assertEqual(commands, ((SANDBOX_RESET_CHILD, True),))
+            self.reply(request_id, [(None, None)])
+            for _ in range(100):
+                if sorted(listdir(self.sandbox_dir)) == ['in', 'out'] and \
+                   reset_stats()['count'] > count:
+                    break
+                await sleep(0.01)
+        run(reset())
+        self.assertEqual(listdir(self.sandbox.in_dir), ['package'])
+        self.assertEqual(listdir(self.sandbox.out_dir), [])
+        self.assertEqual(sorted(listdir(self.sandbox_dir)), ['in', 'out'])
+        self.assertIs(self.sandbox.package, object)
+        self.assertEqual(reset_stats()['count'], count + 1)
+
+        run(self.sandbox.reset(out_tmpfs=False))
+        request_id, commands = run(self.receive())
+        self.assertEqual(commands, ((SANDBOX_RESET_CHILD, False),))
+        self.reply(request_id, [(None, None)])
+        run(self.sandbox.unchecked[-1])
+        self.assertEqual(listdir(self.sandbox.in_dir), [])
+        self.assertIsNone(self.sandbox.package)
+
+if __name__ == '__main__':
+    main()
@@ -5,5 +5,6 @@ STATUS_MEMORY_LIMIT_EXCEEDED = 4
 STATUS_RUNTIME_ERROR = 6
 STATUS_COMPILE_ERROR = 7
 STATUS_SYSTEM_ERROR = 8
+STATUS_CANCELED = 9
 STATUS_JUDGING = 20
 STATUS_COMPILING = 21
@@ -0,0 +1,244 @@
+import json
+from appdirs import user_cache_dir
+from asyncio import get_event_loop, Event
+from functools import partial
+from hashlib import sha256
+from os import fdopen, fstat, link, listdir, makedirs, path, \
+               rename, stat, unlink
+from shutil import rmtree
+from tempfile import mkstemp
+from weakref import finalize
+
+from jd4.cache import cache_add_remove_callback, cache_add_size_callback, cache_open, \
+                      cache_resize
+from jd4.case import read_cases, CHUNK_SIZE, CustomJudgeCase, DefaultCase, Subtask
+from jd4.error import FormatError
+from jd4.log import logger
+
+_STORE_DIR = path.join(user_cache_dir('jd4'), '.data')
+_OBJECTS_DIR = path.join(_STORE_DIR, 'objects')
+_MANIFEST_FILE = 'manifest.json'
+_manifests = dict()
+_events = dict()
+_refs = dict()
+
+class _VersionRef:
+    """Keeps a version from removal while cases made from it are alive."""
+    def __init__(self, key):
+        _refs[key] = _refs.get(key, 0) + 1
+        finalize(self, get_event_loop().call_soon_threadsafe, _release, key).atexit = False
+
+def _release(key):
+    _refs[key] -= 1
+    if _refs[key]:
+        return
+    del _refs[key]
+    domain_id, pid, version = key
+    manifest = _manifests.get((domain_id, pid))
+    if not manifest or manifest[0] != version:
+        get_event_loop().run_in_executor(
+            None, _remove_version, path.join(_STORE_DIR, domain_id, pid, version))
+
+def _in_use(domain_id, pid):
+    return set(version for key_domain_id, key_pid, version in list(_refs)
+               if (key_domain_id, key_pid) == (domain_id, pid))
+
+def _put_object(open_file, normalize, version_dir):
+    fd, tmp_file_path = mkstemp(prefix='tmp_', dir=_OBJECTS_DIR)
+    digest = sha256()
+    try:
+        with fdopen(fd, 'wb') as dst, open_file() as src:
+            while True:
+                buf = src.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                if normalize:
+                    buf = buf.replace(b'\r', b'')
+                digest.update(buf)
+                dst.write(buf)
+        name = digest.hexdigest()
+        # Link into the version first, an object linked nowhere else may be
+        # collected at any time.
+        version_path = path.join(version_dir, name)
+        try:
+            link(tmp_file_path, version_path)
+        except FileExistsError:
+            return name
+        object_path = path.join(_OBJECTS_DIR, name)
+        try:
+            link(tmp_file_path, object_path)
+        except FileExistsError:
+            # Share the existing object, unless it was just collected.
+            try:
+                link(object_path, tmp_file_path + '_link')
+            except FileNotFoundError:
+                return name
+            rename(tmp_file_path + '_link', version_path)
+        return name
+    finally:
+        unlink(tmp_file_path)
+
+def _extract(file, version, problem_dir):
+    makedirs(_OBJECTS_DIR, exist_ok=True)
+    makedirs(problem_dir, exist_ok=True)
+    tmp_dir = path.join(problem_dir, 'tmp_' + version)
+    rmtree(tmp_dir, ignore_errors=True)
+    makedirs(tmp_dir)
+    entries = list()
+    for case in read_cases(file):
+        if isinstance(case, DefaultCase):
+            entries.append({'type': 'default',
+                            'input': _put_object(case.open_input, True, tmp_dir),
+                            'output': _put_object(case.open_output, False, tmp_dir),
+                            'time_ns': case.time_limit_ns,
+                            'memory_bytes': case.memory_limit_bytes,
+                            'score': case.score})
+        elif isinstance(case, CustomJudgeCase):
+            entries.append({'type': 'custom',
+                            'input': _put_object(case.open_input, True, tmp_dir),
+                            'judge': _put_object(case.open_judge, False, tmp_dir),
+                            'judge_lang': case.judge_lang,
+                            'time_ns': case.time_ns,
+                            'memory_bytes': case.memory_bytes})
+        else:
+            raise FormatError('unsupported case type')
+        if case.subtask:
+            entries[-1]['subtask'] = {'id': case.subtask.id,
+                                      'depends': case.subtask.depends}
+    with open(path.join(tmp_dir, _MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(entries, manifest_file)
+    version_dir = path.join(problem_dir, version)
+    rmtree(version_dir, ignore_errors=True)
+    rename(tmp_dir, version_dir)
+    return entries
+
+def _collect(names):
+    for name in names:
+        if name.startswith('tmp_'):
+            continue
+        object_path = path.join(_OBJECTS_DIR, name)
+        try:
+            if stat(object_path).st_nlink == 1:
+                unlink(object_path)
+        except FileNotFoundError:
+            pass
+
+def _remove_version(version_dir):
+    try:
+        names = listdir(version_dir)
+    except FileNotFoundError:
+        return
+    rmtree(version_dir, ignore_errors=True)
+    _collect(names)
+
+def _remove_versions(problem_dir, keep):
+    try:
+        names = listdir(problem_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name not in keep:
+            _remove_version(path.join(problem_dir, name))
+
+def _remove_problem(domain_id, pid):
+    # Versions still in use are removed when released.
+    _manifests.pop((domain_id, pid), None)
+    _remove_versions(path.join(_STORE_DIR, domain_id, pid), _in_use(domain_id, pid))
+    try:
+        _collect(listdir(_OBJECTS_DIR))
+    except FileNotFoundError:
+        pass
+
+def _problem_size(domain_id, pid):
+    problem_dir = path.join(_STORE_DIR, domain_id, pid)
+    size = 0
+    try:
+        versions = listdir(problem_dir)
+    except FileNotFoundError:
+        return 0
+    for version in versions:
+        version_dir = path.join(problem_dir, version)
+        try:
+            size += sum(stat(path.join(version_dir, name)).st_size
+                        for name in listdir(version_dir))
+        except FileNotFoundError:
+            pass
+    return size
+
+def _load(file, version, problem_dir):
+    try:
+        with open(path.join(problem_dir, version, _MANIFEST_FILE)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return _extract(file, version, problem_dir)
+
+def _make_cases(version_dir, entries, checkers):
+    def object_path(name):
+        return path.join(version_dir, name)
+
+    def open_object(name):
+        return open(object_path(name), 'rb')
+
+    subtasks = dict()
+    for entry in entries:
+        if entry['type'] == 'default':
+            case = DefaultCase(partial(open_object, entry['input']),
+                               partial(open_object, entry['output']),
+                               entry['time_ns'],
+                               entry['memory_bytes'],
+                               entry['score'],
+                               input_path=object_path(entry['input']))
+        else:
+            case = CustomJudgeCase(partial(open_object, entry['input']),
+                                   entry['time_ns'],
+                                   entry['memory_bytes'],
+                                   partial(open_object, entry['judge']),
+                                   entry['judge_lang'],
+                                   checkers,
+                                   input_path=object_path(entry['input']))
+        subtask = entry.get('subtask')
+        if subtask:
+            if subtask['id'] not in subtasks:
+                subtasks[subtask['id']] = Subtask(subtask['id'], subtask['depends'])
+            case.subtask = subtasks[subtask['id']]
+        yield case
+
+async def store_cases(session, domain_id, pid, checkers):
+    loop = get_event_loop()
+    problem_dir = path.join(_STORE_DIR, domain_id, pid)
+    loaded = False
+    while True:
+        with await cache_open(session, domain_id, pid) as file:
+            stat = fstat(file.fileno())
+            version = '{}-{}-{}'.format(stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            manifest = _manifests.get((domain_id, pid))
+            if manifest and manifest[0] == version:
+                entries = manifest[1]
+                break
+            event = _events.get((domain_id, pid))
+            if not event:
+                event = Event()
+                _events[(domain_id, pid)] = event
+                try:
+                    entries = await loop.run_in_executor(
+                        None, _load, file, version, problem_dir)
+                    _manifests[(domain_id, pid)] = version, entries
+                    logger.debug('Loaded %s/%s version %s', domain_id, pid, version)
+                finally:
+                    event.set()
+                    del _events[(domain_id, pid)]
+                loaded = True
+                break
+        await event.wait()
+    version_ref = _VersionRef((domain_id, pid, version))
+    if loaded:
+        await loop.run_in_executor(None, _remove_versions, problem_dir,
+                                   _in_use(domain_id, pid))
+        await cache_resize(domain_id, pid)
+    cases = list(_make_cases(path.join(problem_dir, version), entries, checkers))
+    for case in cases:
+        case.version_ref = version_ref
+    return cases
+
+cache_add_remove_callback(_remove_problem)
+cache_add_size_callback(_problem_size)
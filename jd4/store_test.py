@@ -0,0 +1,105 @@
+from asyncio import get_event_loop, sleep
+from gc import collect
+from os import listdir, path, stat
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4 import store
+from jd4.case import CustomJudgeCase
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+class StoreTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.old_dirs = store._STORE_DIR, store._OBJECTS_DIR
+        store._STORE_DIR = self.tmp_dir.name
+        store._OBJECTS_DIR = path.join(self.tmp_dir.name, 'objects')
+
+    def tearDown(self):
+        store._STORE_DIR, store._OBJECTS_DIR = self.old_dirs
+        store._manifests.clear()
+        self.tmp_dir.cleanup()
+
+    def load(self, name, version='1', pid=None):
+        problem_dir = path.join(self.tmp_dir.name, 'domain', pid or name)
+        with open(path.join(path.dirname(__file__), 'testdata', name + '.zip'),
+                  'rb') as file:
+            entries = store._load(file, version, problem_dir)
+        return list(store._make_cases(path.join(problem_dir, version), entries,
+                                      dict()))
+
+    def test_yaml_case(self):
+        cases = self.load('aplusb')
+        self.assertEqual(len(cases), 10)
+        for case in cases:
+            self.assertEqual(case.time_limit_ns, 1000000000)
+            self.assertEqual(case.memory_limit_bytes, 33554432)
+            self.assertEqual(case.score, 10)
+            with case.open_input() as input_file, case.open_output() as output_file:
+                input_data = input_file.read()
+                self.assertNotIn(b'\r', input_data)
+                self.assertEqual(sum(map(int, input_data.split())),
+                                 int(output_file.read()))
+
+    def test_custom_judge_case(self):
+        cases = self.load('decompose-sum')
+        self.assertEqual(len(cases), 4)
+        for case in cases:
+            self.assertIsInstance(case, CustomJudgeCase)
+            with case.open_judge() as judge_file:
+                self.assertIn(b'main', judge_file.read())
+        self.assertEqual(len(listdir(path.join(self.tmp_dir.name, 'objects'))), 5)
+
+    def test_subtask_case(self):
+        cases = self.load('aplusb-subtask')
+        self.assertEqual([case.subtask.id for case in cases],
+                         [1] * 3 + [2] * 3 + ['last'] * 4)
+        self.assertEqual(cases[3].subtask.depends, [1])
+        self.assertIs(cases[3].subtask, cases[5].subtask)
+
+    def test_dedup_and_reload(self):
+        self.load('aplusb')
+        self.load('aplusb-legacy')
+        objects_dir = path.join(self.tmp_dir.name, 'objects')
+        names = listdir(objects_dir)
+        self.assertTrue(any(stat(path.join(objects_dir, name)).st_nlink > 2
+                            for name in names))
+        self.load('aplusb', '2')
+        problem_dir = path.join(self.tmp_dir.name, 'domain', 'aplusb')
+        store._remove_versions(problem_dir, {'2'})
+        self.assertEqual(listdir(problem_dir), ['2'])
+        self.assertEqual(sorted(listdir(objects_dir)), sorted(names))
+
+    def test_version_in_use(self):
+        problem_dir = path.join(self.tmp_dir.name, 'domain', 'aplusb')
+        objects_dir = path.join(self.tmp_dir.name, 'objects')
+        cases = self.load('aplusb')
+        version_ref = store._VersionRef(('domain', 'aplusb', '1'))
+        for case in cases:
+            case.version_ref = version_ref
+        del case, version_ref
+        self.load('decompose-sum', '2', 'aplusb')
+        store._manifests[('domain', 'aplusb')] = '2', None
+        store._remove_versions(problem_dir, store._in_use('domain', 'aplusb') | {'2'})
+        self.assertEqual(sorted(listdir(problem_dir)), ['1', '2'])
+        with cases[0].open_input() as file:
+            self.assertTrue(file.read())
+        del cases
+        collect()
+        run(sleep(0.1))
+        self.assertEqual(listdir(problem_dir), ['2'])
+        self.assertEqual(len(listdir(objects_dir)), 5)
+        self.assertFalse(store._refs)
+
+    def test_remove_problem(self):
+        self.load('aplusb')
+        self.load('decompose-sum')
+        self.assertGreater(store._problem_size('domain', 'aplusb'), 0)
+        store._remove_problem('domain', 'aplusb')
+        self.assertEqual(store._problem_size('domain', 'aplusb'), 0)
+        self.assertEqual(len(listdir(path.join(self.tmp_dir.name, 'objects'))), 5)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import json
+from asyncio import get_event_loop
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import listdir, makedirs, path, stat, unlink
+from random import random
+from time import perf_counter_ns, time
+
+from jd4.config import config
+from jd4.log import logger
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_MAX_FILES = 1000
+_trace = ContextVar('trace', default=None)
+_thread = ContextVar('thread', default='handler')
+
+class Trace:
+    """Spans of a record in the Chrome trace event format.
+
+    Every thread name gets its own track, so spans running concurrently,
+    such as a case and its I/O threads, do not overlap on a track."""
+    def __init__(self, name):
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+                        'args': {'name': name}}]
+        self.threads = dict()
+
+    def add(self, name, thread, start_ns, end_ns, args):
+        tid = self.threads.get(thread)
+        if tid is None:
+            tid = self.threads[thread] = len(self.threads) + 1
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                                'args': {'name': thread}})
+        self.events.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': tid,
+                            'ts': start_ns / 1000, 'dur': (end_ns - start_ns) / 1000,
+                            'args': args})
+
+def trace_start(name):
+    """Starts tracing the current context if sampled and trace_dir is set."""
+    if not config.get('trace_dir') or \
+       random() >= config.get('trace_sample_rate', DEFAULT_SAMPLE_RATE):
+        _trace.set(None)
+        return
+    _trace.set(Trace(name))
+
+async def trace_finish(file_name):
+    trace = _trace.get()
+    if not trace:
+        return
+    _trace.set(None)
+    trace_dir = config['trace_dir']
+    file_path = path.join(trace_dir, '{}-{}.json'.format(file_name, int(time())))
+
+    def write():
+        makedirs(trace_dir, exist_ok=True)
+        with open(file_path, 'w') as file:
+            json.dump({'traceEvents': trace.events, 'displayTimeUnit': 'ms'}, file)
+        _rotate(trace_dir, config.get('trace_max_files', DEFAULT_MAX_FILES))
+
+    try:
+        await get_event_loop().run_in_executor(None, write)
+    except OSError as e:
+        logger.warning('Failed to write trace %s: %r', file_path, e)
+        return
+    logger.debug('Trace written to %s', file_path)
+
+def _rotate(trace_dir, max_files):
+    """Removes the oldest trace files beyond max_files, 0 keeps all."""
+    if not max_files:
+        return
+    file_paths = [path.join(trace_dir, name)
+                  for name in listdir(trace_dir) if name.endswith('.json')]
+    if len(file_paths) <= max_files:
+        return
+    mtimes = dict()
+    for file_path in file_paths:
+        try:
+            mtimes[file_path] = stat(file_path).st_mtime
+        except FileNotFoundError:
+            pass
+    for file_path in sorted(mtimes, key=mtimes.get)[:len(mtimes) - max_files]:
+        try:
+            unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+@contextmanager
+def trace_span(name, thread=None, **args):
+    """Records a span on the current thread, or on a thread named after it."""
+    trace = _trace.get()
+    if not trace:
+        yield
+        return
+    thread = _thread.get() + ' ' + thread if thread else _thread.get()
+    start_ns = perf_counter_ns()
+    try:
+        yield
+    finally:
+        trace.add(name, thread, start_ns, perf_counter_ns(), args)
+
+async def trace_timed(name, awaitable, thread=None, **args):
+    with trace_span(name, thread, **args):
+        return await awaitable
+
+async def trace_thread(thread, awaitable):
+    """Awaits in a task of its own with spans recorded on the named thread."""
+    _thread.set(thread)
+    return await awaitable
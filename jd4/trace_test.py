@@ -0,0 +1,83 @@
+import json
+from asyncio import gather, get_event_loop, sleep
+from os import listdir, path, utime
+from tempfile import TemporaryDirectory
+from unittest import main, TestCase
+
+from jd4.config import config
+from jd4.util import write_text_file
+from jd4.trace import trace_finish, trace_span, trace_start, trace_thread, trace_timed
+
+def run(coro):
+    return get_event_loop().run_until_complete(coro)
+
+async def judge_case():
+    with trace_span('wait'):
+        await sleep(0)
+    await gather(trace_timed('execute', sleep(0.01)),
+                 trace_timed('output', sleep(0.01), 'output'))
+
+async def record(rid):
+    loop = get_event_loop()
+    trace_start('record {}'.format(rid))
+    with trace_span('handler', rid=rid):
+        await gather(*(loop.create_task(trace_thread('case {}'.format(index), judge_case()))
+                       for index in (1, 2)))
+    await trace_finish(rid)
+
+class TraceTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        config['trace_dir'] = self.tmp_dir.name
+        config['trace_sample_rate'] = 1
+
+    def tearDown(self):
+        config.pop('trace_dir', None)
+        config.pop('trace_sample_rate', None)
+        config.pop('trace_max_files', None)
+        self.tmp_dir.cleanup()
+
+    def test_trace(self):
+        run(record('r1'))
+        names = listdir(self.tmp_dir.name)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith('r1-'))
+        with open(path.join(self.tmp_dir.name, names[0])) as file:
+            events = json.load(file)['traceEvents']
+        threads = {event['tid']: event['args']['name']
+                   for event in events if event['name'] == 'thread_name'}
+        self.assertEqual(sorted(threads.values()),
+                         ['case 1', 'case 1 output', 'case 2', 'case 2 output', 'handler'])
+        spans = sorted((threads[event['tid']], event['name'])
+                       for event in events if event['ph'] == 'X')
+        self.assertEqual(spans, [('case 1', 'execute'), ('case 1', 'wait'),
+                                 ('case 1 output', 'output'),
+                                 ('case 2', 'execute'), ('case 2', 'wait'),
+                                 ('case 2 output', 'output'), ('handler', 'handler')])
+        handler, = (event for event in events if event['name'] == 'handler')
+        self.assertEqual(handler['args'], {'rid': 'r1'})
+        self.assertGreaterEqual(handler['dur'], 10000)
+
+    def test_rotate(self):
+        config['trace_max_files'] = 2
+        for index, name in enumerate(('old-1.json', 'old-2.json', 'other.txt')):
+            write_text_file(path.join(self.tmp_dir.name, name), '{}')
+            utime(path.join(self.tmp_dir.name, name), (index, index))
+        run(record('r1'))
+        names = sorted(listdir(self.tmp_dir.name))
+        self.assertEqual(names[:2], ['old-2.json', 'other.txt'])
+        self.assertEqual(len(names), 3)
+        self.assertTrue(names[2].startswith('r1-'))
+
+    def test_not_sampled(self):
+        config['trace_sample_rate'] = 0
+        run(record('r1'))
+        self.assertEqual(listdir(self.tmp_dir.name), [])
+
+    def test_disabled(self):
+        del config['trace_dir']
+        run(record('r1'))
+        self.assertEqual(listdir(self.tmp_dir.name), [])
+
+if __name__ == '__main__':
+    main()
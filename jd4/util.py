@@ -1,8 +1,8 @@
 import re
 from asyncio import get_event_loop, StreamReader, StreamReaderProtocol
-from os import fdopen, listdir, open as os_open, path, remove, waitpid, \
+from os import fdopen, link, open as os_open, path, stat, waitpid, \
                O_RDONLY, O_NONBLOCK, WEXITSTATUS, WIFSIGNALED, WNOHANG, WTERMSIG
-from shutil import rmtree
+from shutil import copytree
 
 from jd4.error import FormatError
 
@@ -11,14 +11,11 @@ TIME_UNITS = {'': 1000000000, 'm': 1000000, 'u': 1000, 'n': 1}
 MEMORY_RE = re.compile(r'([0-9]+(?:\.[0-9]*)?)([kmg]?)b?')
 MEMORY_UNITS = {'': 1, 'k': 1024, 'm': 1048576, 'g': 1073741824}
 
-def remove_under(*dirnames):
-    for dirname in dirnames:
-        for name in listdir(dirname):
-            full_path = path.join(dirname, name)
-            if path.isdir(full_path):
-                rmtree(full_path)
-            else:
-                remove(full_path)
+def link_tree(src, dst):
+    if stat(src).st_dev == stat(path.dirname(dst)).st_dev:
+        copytree(src, dst, copy_function=link)
+    else:
+        copytree(src, dst)
 
 def wait_and_reap_zombies(pid):
     _, status = waitpid(pid, 0)